@@ -7,6 +7,38 @@ from app.utils.logging_config import logger
 
 API_URL=CLOUDSTACK["endpoint"]
 
+# Items asked for per page by cs_list_all
+CS_PAGE_SIZE = 500
+
+def _credentials(request: Request):
+    """
+    The API key and secret key the request signs its commands with.
+    """
+    token_info = getattr(request.state, "token_info", None) if request else None
+    if token_info:
+        # Use Bearer token credentials
+        apikey = token_info.get("apikey")
+        secretkey = token_info.get("secretkey")
+        if not apikey or not secretkey:
+            raise ValueError("OAuth token missing API credentials")
+        return apikey, secretkey
+
+    # Use Basic auth session
+    if request is None or not hasattr(request.state, "auth_hash"):
+        raise ValueError("auth_hash is required for signed commands")
+
+    session = get_session(request.state.auth_hash)
+    if session is None:
+        raise ValueError("No session found for auth_hash")
+    return session["apikey"], session["secretkey"]
+
+def account_key(request: Request) -> str:
+    """
+    The API key of the caller, to keep data listed with its credentials apart
+    from what other accounts see.
+    """
+    return _credentials(request)[0]
+
 async def cs_request(request: Request, command: str, params: dict, method: str = "GET"):
     params["command"] = command
     params["response"] = "json"
@@ -21,28 +53,9 @@ async def cs_request(request: Request, command: str, params: dict, method: str =
 
     # Skip signature for login/logout/getUserKeys
     if command.lower() not in ("login", "logout", "getuserkeys"):
-        if token_info:
-            # Use Bearer token credentials
-            apikey = token_info.get("apikey")
-            secretkey = token_info.get("secretkey")
-            if not apikey or not secretkey:
-                raise ValueError("OAuth token missing API credentials")
-            params["apikey"] = apikey
-            params["signature"] = generate_signature(params, secretkey)
-        else:
-            # Use Basic auth session
-            if request is None or not hasattr(request.state, "auth_hash"):
-                raise ValueError("auth_hash is required for signed commands")
-
-            auth_hash = request.state.auth_hash
-            session = get_session(auth_hash)
-            if session is None:
-                raise ValueError("No session found for auth_hash")
-
-            apikey = session["apikey"]
-            secretkey = session["secretkey"]
-            params["apikey"] = apikey
-            params["signature"] = generate_signature(params, secretkey)
+        apikey, secretkey = _credentials(request)
+        params["apikey"] = apikey
+        params["signature"] = generate_signature(params, secretkey)
 
     cookies = {}
     if command.lower() in ("getuserkeys", "logout"):
@@ -81,3 +94,23 @@ async def cs_request(request: Request, command: str, params: dict, method: str =
         logger.debug(f"CloudStack response for {command}: {r.status_code}")
         return r.json()
 
+async def cs_list_all(request: Request, command: str, params: dict, response: str, item: str,
+                      max_pages: int = None):
+    """
+    All items of a CloudStack list command, asked for page by page until a
+    page comes back short. Returns None without listing the rest when the
+    first page shows more than max_pages pages are needed.
+    """
+    items = []
+    page = 1
+    while True:
+        data = await cs_request(request, command, dict(params, page=page, pagesize=CS_PAGE_SIZE))
+        body = data.get(response, {})
+        batch = body.get(item, [])
+        items.extend(batch)
+        count = body.get("count", 0)
+        if page == 1 and max_pages is not None and -(-count // CS_PAGE_SIZE) > max_pages:
+            return None
+        if len(batch) < CS_PAGE_SIZE or (count and len(items) >= count):
+            return items
+        page += 1
@@ -11,3 +11,8 @@ SECURITY = config["security"]
 SSL = config["ssl"]
 IMAGEIO = config["imageio"]
 
+
+# Optional sections
+if not config.has_section("inventory"):
+    config.add_section("inventory")
+INVENTORY = config["inventory"]
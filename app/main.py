@@ -5,6 +5,8 @@ from app.security.auth_middleware import oVirtAPIAuthMiddleware
 from app.utils.request_logging import RequestLoggingMiddleware
 from app.config import SERVER
 from app.utils.logging_config import setup_logging
+from app.state.inventory_sync import start_sync, stop_sync
+from contextlib import asynccontextmanager
 
 import uvicorn
 import logging
@@ -16,11 +18,19 @@ logger.info("Starting CloudStack oVirtAPI Server")
 cert_file, key_file, ca_cert_file = ensure_certificates()
 logger.info(f"Using certificates: {cert_file}, {key_file}, CA: {ca_cert_file}")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Optional background inventory mirror, see [inventory] in config.ini
+    start_sync()
+    yield
+    await stop_sync()
+
 app = FastAPI(
     title="CloudStack oVirtAPI Server",
     docs_url=None,
     redoc_url=None,
-    openapi_url=None
+    openapi_url=None,
+    lifespan=lifespan
 )
 
 # PKI services don't require authentication - add BEFORE auth middleware
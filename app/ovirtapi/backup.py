@@ -2,6 +2,7 @@ from fastapi import APIRouter, Response, Request, HTTPException
 from app.cloudstack.client import cs_request
 from app.ovirtapi.backup_state import create_backup, get_backup, get_vm_backups, remove_backup, update_backup
 from app.utils.response_builder import create_response
+from app.state import inventory
 import httpx
 from app.config import IMAGEIO
 import json
@@ -29,19 +30,14 @@ async def create_backup_endpoint(vm_id: str, request: Request):
     vm_name = vm["instancename"]
 
     # 2. Get Host of running VM, or a random host if VM is not running
+    target_host = None
     if vm.get("state") == "Running":
         # If VM is running, use its host
-        target_host_id = vm.get("hostid")
-        if target_host_id:
-            host_data = await cs_request(request, "listHosts", {"id": target_host_id})
-            hosts = host_data["listhostsresponse"].get("host", [])
-            if hosts:
-                target_host = hosts[0]
+        target_host = await inventory.get_host(request, vm.get("hostid"))
     else:
         # If VM is not running, get a random host
         # TODO: This should be changed to get the host that should access the volume
-        hosts_data = await cs_request(request, "listHosts", {"type": "Routing"})
-        hosts = hosts_data["listhostsresponse"].get("host", [])
+        hosts = list((await inventory.refresh_hosts(request)).values())
         if hosts:
             import random
             target_host = random.choice(hosts)
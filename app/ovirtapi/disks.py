@@ -2,6 +2,7 @@ from fastapi import APIRouter, Request, HTTPException, Response
 from app.cloudstack.client import cs_request
 from app.utils.response_builder import create_response
 from app.utils.async_job import wait_for_job, get_job_id
+from app.state import inventory_sync
 
 import json
 
@@ -101,8 +102,11 @@ async def list_disks(request: Request):
     Lists all disks (volumes) in the system.
     """
     try:
-        data = await cs_request(request, "listVolumes", {})
-        volumes = data["listvolumesresponse"].get("volume", [])
+        if inventory_sync.is_fresh(request):
+            volumes = inventory_sync.mirrored_volumes()
+        else:
+            data = await cs_request(request, "listVolumes", {})
+            volumes = data["listvolumesresponse"].get("volume", [])
         
         payload = [cs_volume_to_ovirt(volume) for volume in volumes]
         
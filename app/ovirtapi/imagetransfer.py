@@ -11,6 +11,7 @@ from app.config import SERVER, IMAGEIO
 from app.security.certs import get_default_ip
 from app.config import config
 from app.ovirtapi.backup_state import get_backup
+from app.state import inventory
 
 INTERNAL_TOKEN = IMAGEIO.get( "internal_token", fallback="")
 
@@ -82,13 +83,9 @@ async def create_image_transfer(request: Request):
             vm_info = vms[0]
             if vm_info.get("state") == "Running":
                 # If VM is running, use its host
-                target_host_id = vm_info.get("hostid")
-                if target_host_id:
-                    host_data = await cs_request(request, "listHosts", {"id": target_host_id})
-                    hosts = host_data["listhostsresponse"].get("host", [])
-                    if hosts:
-                        target_host = hosts[0]
-                        target_host_ip = target_host.get("ipaddress")
+                target_host = await inventory.get_host(request, vm_info.get("hostid"))
+                if target_host:
+                    target_host_ip = target_host.get("ipaddress")
 
     backup = None
     if backup_id:
@@ -100,8 +97,7 @@ async def create_image_transfer(request: Request):
     if not target_host_ip:
         # If VM is not running, get a random host
         # TODO: This should be changed to get the host that should access the volume
-        hosts_data = await cs_request(request, "listHosts", {"type": "Routing"})
-        hosts = hosts_data["listhostsresponse"].get("host", [])
+        hosts = list((await inventory.refresh_hosts(request)).values())
         if hosts:
             import random
             target_host = random.choice(hosts)
@@ -2,6 +2,7 @@ from fastapi import APIRouter, Request, HTTPException
 
 from app.cloudstack.client import cs_request
 from app.utils.response_builder import create_response
+from app.state import inventory, inventory_sync
 
 router = APIRouter()
 
@@ -49,8 +50,7 @@ def cs_cluster_to_ovirt(cluster: dict) -> dict:
 
 @router.get("/clusters")
 async def list_clusters(request: Request):
-    data = await cs_request(request, "listClusters", {})
-    clusters = data["listclustersresponse"].get("cluster", [])
+    clusters = list((await inventory.refresh_clusters(request, force=True)).values())
 
     payload = [cs_cluster_to_ovirt(cluster) for cluster in clusters]
 
@@ -58,13 +58,12 @@ async def list_clusters(request: Request):
 
 @router.get("/clusters/{cluster_id}")
 async def get_cluster(cluster_id: str, request: Request):
-    data = await cs_request(request, "listClusters", {"id": cluster_id})
-    clusters = data["listclustersresponse"].get("cluster", [])
+    cluster = await inventory.get_cluster(request, cluster_id)
 
-    if not clusters:
+    if not cluster:
         raise HTTPException(status_code=404, detail="Cluster not found")
 
-    cluster = cs_cluster_to_ovirt(clusters[0])
+    cluster = cs_cluster_to_ovirt(cluster)
 
     return create_response(request, "cluster", cluster)
 
@@ -184,9 +183,10 @@ def cs_host_to_ovirt(host: dict) -> dict:
 
 @router.get("/hosts")
 async def list_hosts(request: Request):
-    data = await cs_request(request, "listHosts",
-        { "type": "Routing" })
-    hosts = data["listhostsresponse"].get("host", [])
+    if inventory_sync.is_fresh(request):
+        hosts = inventory_sync.mirrored_hosts()
+    else:
+        hosts = list((await inventory.refresh_hosts(request, force=True)).values())
 
     payload = [cs_host_to_ovirt(host) for host in hosts]
 
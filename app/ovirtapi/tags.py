@@ -1,6 +1,7 @@
 from fastapi import APIRouter, Request, HTTPException
 from app.cloudstack.client import cs_request
 from app.utils.response_builder import create_response
+from app.state.inventory import index_tags, get_tag
 import json
 import uuid
 
@@ -31,6 +32,7 @@ vm_tags = [ {
     "href" : "/ovirt-engine/api/tags/00000000-0000-0000-0000-000000000000",
     "id" : "00000000-0000-0000-0000-000000000000"
   } ]
+index_tags(vm_tags)
 
 @router.get("/tags")
 async def list_tags(request: Request):
@@ -52,8 +54,7 @@ async def list_tags(request: Request):
             all_tags.append(vm_tag)
         for cs_tag in cs_tags:
             tag_name = cs_tag.get("value")
-            matched_tag = next((t for t in vm_tags if t.get("name") == tag_name), None)
-            if not matched_tag:
+            if not get_tag(tag_name):
                 all_tags.append({
                     "id": tag_name,
                     "name": tag_name,
@@ -101,7 +102,7 @@ async def assign_tag_to_vm(vm_id: str, request: Request):
         }, method="POST")
 
         # Find the matching tag definition from the static vm_tags list
-        matched_tag = next((t for t in vm_tags if t.get("name") == tag_name), None)
+        matched_tag = get_tag(tag_name)
         if matched_tag:
             payload = {**matched_tag, "vm": {"id": vm_id}}
         else:
@@ -1,9 +1,12 @@
-from fastapi import APIRouter, Request, HTTPException, Response
-from app.cloudstack.client import cs_request
+from fastapi import APIRouter, Request, HTTPException, Response, Query
+from app.cloudstack.client import cs_request, cs_list_all
 from app.utils.response_builder import create_response
 from app.utils.async_job import wait_for_job, get_job_id
 from app.config import SERVER
 from app.utils.logging_config import logger
+from app.state.ovf_cache import OVF_NOW, ovf_cache_key, get_ovf, store_ovf, render_ovf, invalidate_ovf
+from app.utils.search import VmSearch
+from app.state import inventory, inventory_sync
 
 import json
 import time
@@ -12,152 +15,305 @@ from typing import Optional
 router = APIRouter()
 api_prefix = SERVER.get("path", "/ovirt-engine") + "/api"
 
-async def cs_vm_to_ovirt(vm: dict, request: Request) -> dict:
+# =========================
+# Static payload templates
+# =========================
+# Everything in a VM payload that does not depend on the VM is built once at
+# import time and shared by all converted payloads, so bulk listings only pay
+# for the id-dependent fields. The shared fragments are read-only.
+
+VM_ACTION_RELS = (
+    "detach", "shutdown", "start", "stop", "suspend", "reset",
+    "autopincpuandnumanodes", "reordermacaddresses", "thawfilesystems",
+    "undosnapshot", "screenshot", "ticket", "reboot", "migrate",
+    "cancelmigration", "commitsnapshot", "clone", "freezefilesystems",
+    "logon", "maintenance", "previewsnapshot", "export",
+)
+
+VM_LINK_RELS = (
+    "snapshots", "applications", "hostdevices", "reporteddevices", "sessions",
+    "backups", "checkpoints", "watchdogs", "graphicsconsoles", "diskattachments",
+    "cdroms", "mediateddevices", "nics", "numanodes", "katelloerrata",
+    "permissions", "tags", "affinitylabels", "statistics",
+)
+
+DISK_ACTION_RELS = ("reduce", "copy", "export", "move", "refreshlun", "convert", "sparsify")
+DISK_LINK_RELS = ("permissions", "disksnapshots", "statistics")
+
+NIC_ACTION_RELS = ("activate", "deactivate")
+NIC_LINK_RELS = ("reporteddevices", "networkfilterparameters", "statistics")
+
+# Listings with more VMs than this list the volumes of the cloud page by page,
+# unless that takes more listVolumes pages than there are VMs in the listing
+BULK_VOLUMES_MIN_VMS = 4
+
+VM_STATUS = {
+    "running": "up",
+    "stopped": "down",
+    "error": "down",
+    "shutdown": "down",
+    "stopping": "powering_down",
+    "starting": "powering_up",
+    "migrating": "migrating",
+    "restoring": "restoring_state",
+    "destroyed": "down",
+    "expunging": "down",
+    "unknown": "unknown",
+}
+
+# Dynamic fields are listed with a None placeholder to keep the key order of the payload
+VM_TEMPLATE = {
+    "status": None,
+    "disk_attachments": None,
+    "nics": None,
+    "original_template": None,
+    "tags": {},
+    "template": None,
+    "actions": None,
+    "name": None,
+    "description": None,
+    "comment": "",
+    "bios": {
+        "boot_menu": {
+            "enabled": "false"
+        },
+        "type": "q35_ovmf"
+    },
+    "cpu": {
+        "architecture": "x86_64",
+        "topology": {
+            "cores": "1",
+            "sockets": "6",
+            "threads": "1"
+        }
+    },
+    "display": {
+        "address": "127.0.0.1",
+        "allow_override": "false",
+        "copy_paste_enabled": "true",
+        "disconnect_action": "LOCK_SCREEN",
+        "disconnect_action_delay": "0",
+        "file_transfer_enabled": "true",
+        "monitors": "1",
+        "smartcard_enabled": "false",
+        "type": "vnc",
+        "video_type": "vga"
+    },
+    "io": {
+        "threads": "1"
+    },
+    "memory": None,
+    "migration": {
+        "auto_converge": "inherit",
+        "compressed": "inherit",
+        "encrypted": "inherit",
+        "parallel_migrations_policy": "inherit"
+    },
+    "origin": "ovirt",
+    "os": None,
+    "sso": {
+        "methods": {
+            "method": [
+                {
+                    "id": "guest_agent"
+                }
+            ]
+        }
+    },
+    "stateless": "false",
+    "type": "server",
+    "usb": {
+        "enabled": "false"
+    },
+    "cluster": None,
+    "quota": None,
+    "link": None,
+    "href": None,
+    "id": None,
+    "auto_pinning_policy": "disabled",
+    "cpu_pinning_policy": "none",
+    "cpu_shares": "0",
+    "creation_time": None,
+    "delete_protected": "false",
+    "high_availability": {
+        "enabled": "false",
+        "priority": "0"
+    },
+    "large_icon": None,
+    "memory_policy": None,
+    "migration_downtime": -1,
+    "multi_queues_enabled": "true",
+    "placement_policy": {
+        "affinity": "migratable"
+    },
+    "small_icon": None,
+    "start_paused": "false",
+    "storage_error_resume_behaviour": "auto_resume",
+    "time_zone": {
+        "name": "Etc/GMT"
+    },
+    "virtio_scsi_multi_queues_enabled": "false",
+    "cpu_profile": None,
+}
+
+VM_OS_BOOT = {
+    "devices": {
+        "device": [
+            "hd"
+        ]
+    }
+}
+
+DISK_ATTACHMENT_TEMPLATE = {
+    "active": "true",
+    "bootable": None,
+    "interface": "virtio_scsi",
+    "logical_name": None,
+    "pass_discard": "false",
+    "read_only": "false",
+    "uses_scsi_reservation": "false",
+    "disk": None,
+    "vm": None,
+    "link": [],
+    "href": None,
+    "id": None,
+}
+
+DISK_TEMPLATE = {
+    "actual_size": None,
+    "alias": None,
+    "backup": "none",
+    "content_type": "data",
+    "format": "cow",
+    "image_id": None,
+    "initial_size": None,
+    "propagate_errors": "false",
+    "provisioned_size": None,
+    "qcow_version": "qcow2_v3",
+    "shareable": "false",
+    "sparse": None,
+    "status": "ok",
+    "storage_type": "image",
+    "total_size": None,
+    "wipe_after_delete": "false",
+    "disk_profile": None,
+    "quota": None,
+    "storage_domains": None,
+    "actions": None,
+    "name": None,
+    "description": None,
+    "link": None,
+    "href": None,
+    "id": None,
+}
+
+NIC_TEMPLATE = {
+    "interface": "virtio",  # Default interface type in CloudStack
+    "linked": "true",
+    "mac": None,
+    "plugged": "true",
+    "synced": "true",
+    "reported_devices": None,
+    "vnic_profile": None,
+    "actions": None,
+    "name": None,
+    "vm": None,
+    "link": None,
+    "href": None,
+    "id": None,
+}
+
+def _links(href: str, rels: tuple) -> list:
+    """
+    Build an oVirt link list for the given base href and link relations.
+    """
+    return [{"href": f"{href}/{rel}", "rel": rel} for rel in rels]
+
+async def cs_vm_to_ovirt(vm: dict, request: Request, volumes: list = None) -> dict:
     """
     Convert a CloudStack VM dict to an oVirt-compatible VM payload with full details.
+    volumes may be passed in by callers that already listed the volumes of the VM.
     """
 
     vm_id = vm.get("id")
+    vm_href = f"/ovirt-engine/api/vms/{vm_id}"
+    vm_ref = {
+        "href": vm_href,
+        "id": vm_id
+    }
 
     # get request parameter all_content
     all_content = request.query_params.get("all_content", "false").lower() == "true"
 
-    # Use match/case to determine VM status
     vm_state = vm.get("state", "down").lower()
-    match vm_state:
-        case "running":
-            vm_status = "up"
-        case "stopped" | "error" | "shutdown":
-            vm_status = "down"
-        case "stopping":
-            vm_status = "powering_down"
-        case "starting":
-            vm_status = "powering_up"
-        case "migrating":
-            vm_status = "migrating"
-        case "restoring":
-            vm_status = "restoring_state"
-        case "destroyed" | "expunging":
-            vm_status = "down"
-        case "unknown":
-            vm_status = "unknown"
-        case _:
-            vm_status = vm_state
+    vm_status = VM_STATUS.get(vm_state, vm_state)
 
     # Get volumes attached to this VM to extract storage information
-    try:
-        volumes_data = await cs_request(request, "listVolumes", {"virtualmachineid": vm_id})
-        volumes = volumes_data["listvolumesresponse"].get("volume", [])
-    except:
-        # If we can't get volumes, use empty list
-        volumes = []
+    if volumes is None:
+        try:
+            volumes_data = await cs_request(request, "listVolumes", {"virtualmachineid": vm_id})
+            volumes = volumes_data["listvolumesresponse"].get("volume", [])
+        except:
+            # If we can't get volumes, use empty list
+            volumes = []
+
+    zone_id = vm.get("zoneid")
+    disk_quota = {
+        "href": f"/ovirt-engine/api/datacenters/{zone_id}/quotas/{zone_id}",
+        "id": f"{zone_id}"
+    }
+    default_disk_name = f"Veeam_KvmBackupDisk_{vm.get('name', 'test-vm')}"
 
     # Create disk attachments with dynamic storage domain IDs
     disk_attachments = []
     for i, volume in enumerate(volumes):
         # Get storage domain ID from the volume
         storage_id = volume.get("storageid", f"dynamic-storage-{i}")
-
-        disk_attachment = {
-            "active": "true",
-            "bootable": str(volume.get("isbootable", True)).lower(),
-            "interface": "virtio_scsi",
-            "logical_name": f"/dev/sd{chr(ord('a') + i)}",
-            "pass_discard": "false",
-            "read_only": "false",
-            "uses_scsi_reservation": "false",
-            "disk": {
-                "actual_size": int(volume.get("size", "1239158784")),
-                "alias": volume.get("name", f"Veeam_KvmBackupDisk_{vm.get('name', 'test-vm')}"),
-                "backup": "none",
-                "content_type": "data",
-                "format": "cow",
-                "image_id": volume.get("id"),
-                "initial_size": int(volume.get("size", "1239158784")),
-                "propagate_errors": "false",
-                "provisioned_size": int(volume.get("size", "107374182400")),
-                "qcow_version": "qcow2_v3",
-                "shareable": "false",
-                "sparse": str(volume.get("issparse", True)).lower(),
-                "status": "ok",
-                "storage_type": "image",
-                "total_size": int(volume.get("size", "1239158784")),
-                "wipe_after_delete": "false",
-                "disk_profile": {
-                    "href": f"/ovirt-engine/api/diskprofiles/{volume.get('id')}",
-                    "id": volume.get('id')
-                },
-                "quota": {
-                    "href": f"/ovirt-engine/api/datacenters/{vm.get('zoneid')}/quotas/{vm.get('zoneid')}",
-                    "id": f"{vm.get('zoneid')}"
-                },
-                "storage_domains": {
-                    "storage_domain": [
-                        {
-                            "href": f"/ovirt-engine/api/storagedomains/{storage_id}",
-                            "id": storage_id
-                        }
-                    ]
-                },
-                "actions": {
-                    "link": [
-                        {
-                            "href": f"/ovirt-engine/api/disks/{volume.get('id')}/reduce",
-                            "rel": "reduce"
-                        },
-                        {
-                            "href": f"/ovirt-engine/api/disks/{volume.get('id')}/copy",
-                            "rel": "copy"
-                        },
-                        {
-                            "href": f"/ovirt-engine/api/disks/{volume.get('id')}/export",
-                            "rel": "export"
-                        },
-                        {
-                            "href": f"/ovirt-engine/api/disks/{volume.get('id')}/move",
-                            "rel": "move"
-                        },
-                        {
-                            "href": f"/ovirt-engine/api/disks/{volume.get('id')}/refreshlun",
-                            "rel": "refreshlun"
-                        },
-                        {
-                            "href": f"/ovirt-engine/api/disks/{volume.get('id')}/convert",
-                            "rel": "convert"
-                        },
-                        {
-                            "href": f"/ovirt-engine/api/disks/{volume.get('id')}/sparsify",
-                            "rel": "sparsify"
-                        }
-                    ]
-                },
-                "name": volume.get("name", f"Veeam_KvmBackupDisk_{vm.get('name', 'test-vm')}"),
-                "description": volume.get("displaytext", ""),
-                "link": [
-                    {
-                        "href": f"/ovirt-engine/api/disks/{volume.get('id')}/permissions",
-                        "rel": "permissions"
-                    },
-                    {
-                        "href": f"/ovirt-engine/api/disks/{volume.get('id')}/disksnapshots",
-                        "rel": "disksnapshots"
-                    },
+        volume_id = volume.get("id")
+        disk_href = f"/ovirt-engine/api/disks/{volume_id}"
+        disk_name = volume.get("name", default_disk_name)
+
+        disk = dict(DISK_TEMPLATE)
+        disk.update({
+            "actual_size": int(volume.get("size", "1239158784")),
+            "alias": disk_name,
+            "image_id": volume_id,
+            "initial_size": int(volume.get("size", "1239158784")),
+            "provisioned_size": int(volume.get("size", "107374182400")),
+            "sparse": str(volume.get("issparse", True)).lower(),
+            "total_size": int(volume.get("size", "1239158784")),
+            "disk_profile": {
+                "href": f"/ovirt-engine/api/diskprofiles/{volume_id}",
+                "id": volume_id
+            },
+            "quota": disk_quota,
+            "storage_domains": {
+                "storage_domain": [
                     {
-                        "href": f"/ovirt-engine/api/disks/{volume.get('id')}/statistics",
-                        "rel": "statistics"
+                        "href": f"/ovirt-engine/api/storagedomains/{storage_id}",
+                        "id": storage_id
                     }
-                ],
-                "href": f"/ovirt-engine/api/disks/{volume.get('id')}",
-                "id": volume.get("id", f"dynamic-disk-{i}")
+                ]
             },
-            "vm": {
-                "href": f"/ovirt-engine/api/vms/{vm_id}",
-                "id": vm_id
+            "actions": {
+                "link": _links(disk_href, DISK_ACTION_RELS)
             },
-            "link": [],
-            "href": f"/ovirt-engine/api/vms/{vm_id}/diskattachments/{volume.get('id')}",
+            "name": disk_name,
+            "description": volume.get("displaytext", ""),
+            "link": _links(disk_href, DISK_LINK_RELS),
+            "href": disk_href,
             "id": volume.get("id", f"dynamic-disk-{i}")
-        }
+        })
+
+        disk_attachment = dict(DISK_ATTACHMENT_TEMPLATE)
+        disk_attachment.update({
+            "bootable": str(volume.get("isbootable", True)).lower(),
+            "logical_name": f"/dev/sd{chr(ord('a') + i)}",
+            "disk": disk,
+            "vm": vm_ref,
+            "href": f"{vm_href}/diskattachments/{volume_id}",
+            "id": volume.get("id", f"dynamic-disk-{i}")
+        })
         disk_attachments.append(disk_attachment)
 
     # Generate NICs dynamically based on VM data
@@ -165,16 +321,15 @@ async def cs_vm_to_ovirt(vm: dict, request: Request) -> dict:
     nics = []
     for i, nic in enumerate(vm_nics):
         nic_id = nic.get("id", f"nic-{i}")
-        mac_address = nic.get("macaddress")
+        nic_href = f"{vm_href}/nics/{nic_id}"
+        mac = {
+            "address": nic.get("macaddress")
+        }
+        vnic_profile_id = nic.get("networkid", f"dynamic-vnic-{i}")
 
-        nic_obj = {
-            "interface": "virtio",  # Default interface type in CloudStack
-            "linked": "true",
-            "mac": {
-                "address": mac_address
-            },
-            "plugged": "true",
-            "synced": "true",
+        nic_obj = dict(NIC_TEMPLATE)
+        nic_obj.update({
+            "mac": mac,
             "reported_devices": {
                 "reported_device": [
                     {
@@ -186,63 +341,44 @@ async def cs_vm_to_ovirt(vm: dict, request: Request) -> dict:
                                 }
                             ]
                         },
-                        "mac": {
-                            "address": mac_address
-                        },
+                        "mac": mac,
                         "type": "network",
-                        "vm": {
-                            "href": f"/ovirt-engine/api/vms/{vm_id}",
-                            "id": vm_id
-                        },
+                        "vm": vm_ref,
                         "name": f"eth{nic.get('deviceid', i)}",
                         "description": "guest reported data",
-                        "href": f"/ovirt-engine/api/vms/{vm_id}/reporteddevices/{nic_id}",
+                        "href": f"{vm_href}/reporteddevices/{nic_id}",
                         "id": nic_id
                     }
                 ]
             },
             "vnic_profile": {
-                "href": f"/ovirt-engine/api/vnicprofiles/{nic.get('networkid', f'dynamic-vnic-{i}')}",
-                "id": nic.get('networkid', f"dynamic-vnic-{i}")
+                "href": f"/ovirt-engine/api/vnicprofiles/{vnic_profile_id}",
+                "id": vnic_profile_id
             },
             "actions": {
-                "link": [
-                    {
-                        "href": f"/ovirt-engine/api/vms/{vm_id}/nics/{nic_id}/activate",
-                        "rel": "activate"
-                    },
-                    {
-                        "href": f"/ovirt-engine/api/vms/{vm_id}/nics/{nic_id}/deactivate",
-                        "rel": "deactivate"
-                    }
-                ]
+                "link": _links(nic_href, NIC_ACTION_RELS)
             },
             "name": f"nic{i+1}",
-            "vm": {
-                "href": f"/ovirt-engine/api/vms/{vm_id}",
-                "id": vm_id
-            },
-            "link": [
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/nics/{nic_id}/reporteddevices",
-                    "rel": "reporteddevices"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/nics/{nic_id}/networkfilterparameters",
-                    "rel": "networkfilterparameters"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/nics/{nic_id}/statistics",
-                    "rel": "statistics"
-                }
-            ],
-            "href": f"/ovirt-engine/api/vms/{vm_id}/nics/{nic_id}",
+            "vm": vm_ref,
+            "link": _links(nic_href, NIC_LINK_RELS),
+            "href": nic_href,
             "id": nic_id
-        }
+        })
         nics.append(nic_obj)
 
-    # Create the detailed VM structure as specified
-    detailed_vm = {
+    template_id = vm.get('templateid', 'dynamic-template')
+    template_ref = {
+        "href": f"/ovirt-engine/api/templates/{template_id}",
+        "id": template_id
+    }
+    large_icon_id = vm.get('iconid', 'dynamic-large-icon')
+    small_icon_id = vm.get('smalliconid', 'dynamic-small-icon')
+    cpu_profile_id = vm.get('cpuprofileid', 'dynamic-cpu-profile')
+    policy_memory = int(vm.get("memory", "1024")) * 1024 * 1024
+
+    # Fill the id-dependent fields of the VM template
+    detailed_vm = dict(VM_TEMPLATE)
+    detailed_vm.update({
         "status": vm_status,
         "disk_attachments": {
             "disk_attachment": disk_attachments
@@ -250,300 +386,51 @@ async def cs_vm_to_ovirt(vm: dict, request: Request) -> dict:
         "nics": {
             "nic": nics
         },
-        "original_template": {
-            "href": f"/ovirt-engine/api/templates/{vm.get('templateid', 'dynamic-template')}",
-            "id": vm.get('templateid', 'dynamic-template')
-        },
-        "tags": {},
-        "template": {
-            "href": f"/ovirt-engine/api/templates/{vm.get('templateid', 'dynamic-template')}",
-            "id": vm.get('templateid', 'dynamic-template')
-        },
+        "original_template": template_ref,
+        "template": template_ref,
         "actions": {
-            "link": [
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/detach",
-                    "rel": "detach"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/shutdown",
-                    "rel": "shutdown"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/start",
-                    "rel": "start"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/stop",
-                    "rel": "stop"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/suspend",
-                    "rel": "suspend"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/reset",
-                    "rel": "reset"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/autopincpuandnumanodes",
-                    "rel": "autopincpuandnumanodes"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/reordermacaddresses",
-                    "rel": "reordermacaddresses"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/thawfilesystems",
-                    "rel": "thawfilesystems"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/undosnapshot",
-                    "rel": "undosnapshot"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/screenshot",
-                    "rel": "screenshot"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/ticket",
-                    "rel": "ticket"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/reboot",
-                    "rel": "reboot"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/migrate",
-                    "rel": "migrate"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/cancelmigration",
-                    "rel": "cancelmigration"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/commitsnapshot",
-                    "rel": "commitsnapshot"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/clone",
-                    "rel": "clone"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/freezefilesystems",
-                    "rel": "freezefilesystems"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/logon",
-                    "rel": "logon"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/maintenance",
-                    "rel": "maintenance"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/previewsnapshot",
-                    "rel": "previewsnapshot"
-                },
-                {
-                    "href": f"/ovirt-engine/api/vms/{vm_id}/export",
-                    "rel": "export"
-                }
-            ]
+            "link": _links(vm_href, VM_ACTION_RELS)
         },
         "name": vm.get("instancename", "veeam-worker"),
         "description": vm.get("displayname", vm.get("name")),
-        "comment": "",
-        "bios": {
-            "boot_menu": {
-                "enabled": "false"
-            },
-            "type": "q35_ovmf"
-        },
-        "cpu": {
-            "architecture": "x86_64",
-            "topology": {
-                "cores": "1",
-                "sockets": "6",
-                "threads": "1"
-            }
-        },
-        "display": {
-            "address": "127.0.0.1",
-            "allow_override": "false",
-            "copy_paste_enabled": "true",
-            "disconnect_action": "LOCK_SCREEN",
-            "disconnect_action_delay": "0",
-            "file_transfer_enabled": "true",
-            "monitors": "1",
-            "smartcard_enabled": "false",
-            "type": "vnc",
-            "video_type": "vga"
-        },
-        "io": {
-            "threads": "1"
-        },
         "memory": int(vm.get("memory", "6144")) * 1024 * 1024,  # Default to 6GB
-        "migration": {
-            "auto_converge": "inherit",
-            "compressed": "inherit",
-            "encrypted": "inherit",
-            "parallel_migrations_policy": "inherit"
-        },
-        "origin": "ovirt",
         "os": {
-            "boot": {
-                "devices": {
-                    "device": [
-                        "hd"
-                    ]
-                }
-            },
+            "boot": VM_OS_BOOT,
             "type": vm.get("ostype", "other")
         },
-        "sso": {
-            "methods": {
-                "method": [
-                    {
-                        "id": "guest_agent"
-                    }
-                ]
-            }
-        },
-        "stateless": "false",
-        "type": "server",
-        "usb": {
-            "enabled": "false"
-        },
         "cluster": {
             "href": f"/ovirt-engine/api/clusters/{vm.get('clusterid')}",
             "id": vm.get('clusterid')
         },
         "quota": {
-            "id": vm.get('zoneid')
+            "id": zone_id
         },
-        "link": [
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/snapshots",
-                "rel": "snapshots"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/applications",
-                "rel": "applications"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/hostdevices",
-                "rel": "hostdevices"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/reporteddevices",
-                "rel": "reporteddevices"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/sessions",
-                "rel": "sessions"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/backups",
-                "rel": "backups"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/checkpoints",
-                "rel": "checkpoints"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/watchdogs",
-                "rel": "watchdogs"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/graphicsconsoles",
-                "rel": "graphicsconsoles"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/diskattachments",
-                "rel": "diskattachments"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/cdroms",
-                "rel": "cdroms"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/mediateddevices",
-                "rel": "mediateddevices"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/nics",
-                "rel": "nics"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/numanodes",
-                "rel": "numanodes"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/katelloerrata",
-                "rel": "katelloerrata"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/permissions",
-                "rel": "permissions"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/tags",
-                "rel": "tags"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/affinitylabels",
-                "rel": "affinitylabels"
-            },
-            {
-                "href": f"/ovirt-engine/api/vms/{vm_id}/statistics",
-                "rel": "statistics"
-            }
-        ],
-        "href": f"/ovirt-engine/api/vms/{vm_id}",
+        "link": _links(vm_href, VM_LINK_RELS),
+        "href": vm_href,
         "id": vm_id,
-        "auto_pinning_policy": "disabled",
-        "cpu_pinning_policy": "none",
-        "cpu_shares": "0",
         "creation_time": int(time.time()),
-        "delete_protected": "false",
-        "high_availability": {
-            "enabled": "false",
-            "priority": "0"
-        },
         "large_icon": {
-            "href": f"/ovirt-engine/api/icons/{vm.get('iconid', 'dynamic-large-icon')}",
-            "id": vm.get('iconid', 'dynamic-large-icon')
+            "href": f"/ovirt-engine/api/icons/{large_icon_id}",
+            "id": large_icon_id
         },
         "memory_policy": {
             "ballooning": "true",
-            "guaranteed": int(vm.get("memory", "1024")) * 1024 * 1024,
-            "max": int(vm.get("memory", "1024")) * 1024 * 1024,
-        },
-        "migration_downtime": -1,
-        "multi_queues_enabled": "true",
-        "placement_policy": {
-            "affinity": "migratable"
+            "guaranteed": policy_memory,
+            "max": policy_memory,
         },
         "small_icon": {
-            "href": f"/ovirt-engine/api/icons/{vm.get('smalliconid', 'dynamic-small-icon')}",
-            "id": vm.get('smalliconid', 'dynamic-small-icon')
-        },
-        "start_paused": "false",
-        "storage_error_resume_behaviour": "auto_resume",
-        "time_zone": {
-            "name": "Etc/GMT"
+            "href": f"/ovirt-engine/api/icons/{small_icon_id}",
+            "id": small_icon_id
         },
-        "virtio_scsi_multi_queues_enabled": "false",
         "cpu_profile": {
-            "href": f"/ovirt-engine/api/cpuprofiles/{vm.get('cpuprofileid', 'dynamic-cpu-profile')}",
-            "id": vm.get('cpuprofileid', 'dynamic-cpu-profile')
+            "href": f"/ovirt-engine/api/cpuprofiles/{cpu_profile_id}",
+            "id": cpu_profile_id
         }
-    }
+    })
 
     if all_content:
-        # Generate the XML data for the VM
-        xml_data = generate_vm_xml(vm, volumes)
+        # Get the XML data for the VM, generated only once per VM configuration
+        xml_data = get_vm_ovf(vm, volumes)
 
         # Add configuratoin data in initialization section
         detailed_vm["initialization"] = {
@@ -562,14 +449,32 @@ async def cs_vm_to_ovirt(vm: dict, request: Request) -> dict:
 
     return detailed_vm
 
-def generate_vm_xml(vm, volumes):
+def get_vm_ovf(vm, volumes):
+    """
+    Return the OVF document of the virtual machine from the cached template,
+    generating it when any field of the VM, its volumes or NICs it uses changed.
+    Its dates are the time of the call.
+    """
+    vm_id = vm.get("id")
+    key = ovf_cache_key(vm, volumes)
+    template = get_ovf(vm_id, key)
+    if template is None:
+        template = generate_vm_xml(vm, volumes, now=OVF_NOW)
+        store_ovf(vm_id, key, template)
+    return render_ovf(template, time.strftime("%Y/%m/%d %H:%M:%S"))
+
+def generate_vm_xml(vm, volumes, now: str = None):
     """
     Generate the OVF document in XML describing the virtual machine.
+    Dates are set to now, the current time by default.
     """
     import xml.etree.ElementTree as ET
     from datetime import datetime
     import uuid
 
+    if now is None:
+        now = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+
     # Create the root element
     envelope = ET.Element("ovf:Envelope")
     envelope.set("xmlns:ovf", "http://schemas.dmtf.org/ovf/envelope/1/")
@@ -637,8 +542,8 @@ def generate_vm_xml(vm, volumes):
     ET.SubElement(content, "Name").text = vm.get("instancename", "unnamed-vm")
     ET.SubElement(content, "Description").text = vm.get("displayname", "")
     ET.SubElement(content, "Comment").text = ""
-    ET.SubElement(content, "CreationDate").text = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-    ET.SubElement(content, "ExportDate").text = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+    ET.SubElement(content, "CreationDate").text = now
+    ET.SubElement(content, "ExportDate").text = now
     ET.SubElement(content, "DeleteProtected").text = "false"
     ET.SubElement(content, "SsoMethod").text = "guest_agent"
     ET.SubElement(content, "IsSmartcardEnabled").text = "false"
@@ -688,8 +593,8 @@ def generate_vm_xml(vm, volumes):
     ET.SubElement(content, "OriginalTemplateId").text = vm.get("templateid", "00000000-0000-0000-0000-000000000000")
     ET.SubElement(content, "OriginalTemplateName").text = "Blank"
     ET.SubElement(content, "UseLatestVersion").text = "false"
-    ET.SubElement(content, "StopTime").text = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-    ET.SubElement(content, "BootTime").text = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+    ET.SubElement(content, "StopTime").text = now
+    ET.SubElement(content, "BootTime").text = now
     ET.SubElement(content, "Downtime").text = "0"
 
     # Operating System Section
@@ -743,9 +648,9 @@ def generate_vm_xml(vm, volumes):
         ET.SubElement(disk_item, "rasd:ApplicationList").text = ""
         ET.SubElement(disk_item, "rasd:StorageId").text = volume.get("storageid", str(uuid.uuid4()))
         ET.SubElement(disk_item, "rasd:StoragePoolId").text = vm.get("zoneid", str(uuid.uuid4()))
-        ET.SubElement(disk_item, "rasd:CreationDate").text = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-        ET.SubElement(disk_item, "rasd:LastModified").text = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-        ET.SubElement(disk_item, "rasd:last_modified_date").text = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        ET.SubElement(disk_item, "rasd:CreationDate").text = now
+        ET.SubElement(disk_item, "rasd:LastModified").text = now
+        ET.SubElement(disk_item, "rasd:last_modified_date").text = now
         ET.SubElement(disk_item, "Type").text = "disk"
         ET.SubElement(disk_item, "Device").text = "disk"
         ET.SubElement(disk_item, "rasd:Address").text = f"{{type=drive, bus=0, controller=0, target=0, unit={i}}}"
@@ -971,7 +876,7 @@ def generate_vm_xml(vm, volumes):
     snapshot_elem = ET.SubElement(snapshots_section, "Snapshot", {"ovf:id": str(uuid.uuid4())})
     ET.SubElement(snapshot_elem, "Type").text = "ACTIVE"
     ET.SubElement(snapshot_elem, "Description").text = "Active VM"
-    ET.SubElement(snapshot_elem, "CreationDate").text = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+    ET.SubElement(snapshot_elem, "CreationDate").text = now
 
     # Convert to string and return
     xml_string = ET.tostring(envelope, encoding="unicode")
@@ -1051,21 +956,51 @@ def parse_ovf(ovf_doc):
     return domainid, account, projectid, cpu_cores, memory
 
 @router.get("/vms")
-async def list_vms(request: Request, follow: Optional[str] = None):
-    data = await cs_request(request,
-        "listVirtualMachines",
-        {}
-    )
-    vms = data["listvirtualmachinesresponse"].get("virtualmachine", [])
+async def list_vms(
+    request: Request,
+    follow: Optional[str] = None,
+    search: Optional[str] = None,
+    max_results: Optional[int] = Query(None, alias="max")
+):
+    # Serve from the inventory mirror when it is enabled and recent enough
+    mirrored = inventory_sync.is_fresh(request)
+    if mirrored:
+        hosts_by_id = inventory_sync.MIRROR["hosts"]
+    else:
+        hosts_by_id = await inventory.refresh_hosts(request)
+    hosts = list(hosts_by_id.values())
+
+    # Translate the oVirt search/max into listVirtualMachines filters,
+    # whatever CloudStack cannot express is filtered in memory
+    try:
+        vm_search = VmSearch(search, max_results, hosts)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid search: {str(e)}")
 
-    host_data = await cs_request(request, "listHosts", {"type": "Routing"})
-    hosts = host_data["listhostsresponse"].get("host", [])
+    if mirrored:
+        vms = vm_search.filter(inventory_sync.mirrored_vms(), local=True)
+    else:
+        data = await cs_request(request,
+            "listVirtualMachines",
+            dict(vm_search.params)
+        )
+        vms = vm_search.filter(data["listvirtualmachinesresponse"].get("virtualmachine", []))
+
+    # List the volumes of all VMs at once instead of once per VM
+    volumes_by_vm = None
+    if mirrored:
+        volumes_by_vm = inventory.VOLUMES_BY_VM
+    elif len(vms) > BULK_VOLUMES_MIN_VMS:
+        volumes = await cs_list_all(request, "listVolumes", {}, "listvolumesresponse", "volume",
+                                    max_pages=len(vms))
+        if volumes is not None:
+            vm_ids = {vm.get("id") for vm in vms}
+            volumes_by_vm = inventory.group_volumes(v for v in volumes if v.get("virtualmachineid") in vm_ids)
 
     follow_tags = follow and "tags" in [f.strip() for f in follow.split(",")]
 
     tags_by_vm = {}
     if follow_tags:
-        from app.ovirtapi.tags import vm_tags as static_vm_tags
         tags_data = await cs_request(request, "listTags", {
             "key": "veeam_tag",
             "resourcetype": "UserVm"
@@ -1074,7 +1009,7 @@ async def list_vms(request: Request, follow: Optional[str] = None):
         for cs_tag in cs_tags:
             vm_id = cs_tag.get("resourceid")
             tag_name = cs_tag.get("value")
-            matched = next((t for t in static_vm_tags if t.get("name") == tag_name), None)
+            matched = inventory.get_tag(tag_name)
             tag_id = matched.get("id") if matched else tag_name
             description = matched.get("description", "") if matched else ""
             tags_by_vm.setdefault(vm_id, []).append({
@@ -1098,11 +1033,14 @@ async def list_vms(request: Request, follow: Optional[str] = None):
         host_id = vm.get("hostid")
         logger.debug(f"host id: {host_id}")
         if host_id:
-            # get host information from hosts data
-            host = next((host for host in hosts if host.get("id") == host_id), None)
+            # get host information from the host index
+            host = hosts_by_id.get(host_id) or await inventory.get_host(request, host_id)
             logger.debug(f"host: {host}")
-            vm["clusterid"] = host.get("clusterid")
-        ovirt_vm = await cs_vm_to_ovirt(vm, request)
+            if host:
+                # Mirrored VMs are shared with other requests, change a copy
+                vm = dict(vm, clusterid=host.get("clusterid"))
+        volumes = volumes_by_vm.get(vm.get("id"), []) if volumes_by_vm is not None else None
+        ovirt_vm = await cs_vm_to_ovirt(vm, request, volumes)
         if follow_tags:
             vm_id = vm.get("id")
             ovirt_vm["tags"] = {"tag": tags_by_vm.get(vm_id, [])}
@@ -1126,17 +1064,13 @@ async def get_vm(vm_id: str, request: Request, follow: Optional[str] = None):
 
     if vm and vm.get("hostid"):
         # get host information based on the vm's hostid
-        host_data = await cs_request(request, "listHosts", {"id": vm.get("hostid")})
-        hosts = host_data["listhostsresponse"].get("host", [])
-
-        if hosts:
-            host = hosts[0]            
-            vm["clusterid"] = host.get("clusterid")
+        host = await inventory.get_host(request, vm.get("hostid"))
+        if host:
+            vm = dict(vm, clusterid=host.get("clusterid"))
 
     payload = await cs_vm_to_ovirt(vm, request)
 
     if follow and "tags" in [f.strip() for f in follow.split(",")]:
-        from app.ovirtapi.tags import vm_tags as static_vm_tags
         tags_data = await cs_request(request, "listTags", {
             "key": "veeam_tag",
             "resourceid": vm_id,
@@ -1146,7 +1080,7 @@ async def get_vm(vm_id: str, request: Request, follow: Optional[str] = None):
         tag_list = []
         for cs_tag in cs_tags:
             tag_name = cs_tag.get("value")
-            matched = next((t for t in static_vm_tags if t.get("name") == tag_name), None)
+            matched = inventory.get_tag(tag_name)
             tag_id = matched.get("id") if matched else tag_name
             description = matched.get("description", "") if matched else ""
             tag_list.append({
@@ -1216,6 +1150,7 @@ async def update_vm(vm_id: str, request: Request):
 
         # Call CloudStack API to update the VM
         update_data = await cs_request(request, "updateVirtualMachine", cs_params)
+        invalidate_ovf(vm_id)
 
         vm = update_data["updatevirtualmachineresponse"].get("virtualmachine", [])
 
@@ -1515,6 +1450,7 @@ async def delete_vm(vm_id: str, request: Request):
 
     # Call CloudStack API to destroy the VM
     data = await cs_request(request, "destroyVirtualMachine", cs_params)
+    invalidate_ovf(vm_id)
 
     # Check for job response (async)
     job_id = get_job_id(data)
@@ -2,6 +2,7 @@ from fastapi import APIRouter, Request, HTTPException
 from app.cloudstack.client import cs_request
 from app.utils.response_builder import create_response
 from app.utils.async_job import wait_for_job, get_job_id
+from app.state.ovf_cache import invalidate_ovf
 
 import json
 import uuid
@@ -123,6 +124,7 @@ async def create_vm_nic(vm_id: str, request: Request):
 
         # Call CloudStack API to add NIC to the VM
         data = await cs_request(request, "addNicToVirtualMachine", cs_params)
+        invalidate_ovf(vm_id)
 
         # Check for job response (async)
         job_id = get_job_id(data)
@@ -0,0 +1,122 @@
+import time
+from fastapi import Request
+from app.cloudstack.client import cs_request, account_key
+from app.config import INVENTORY
+
+# Seconds the host/cluster indexes are trusted before they are reloaded from CloudStack
+INVENTORY_TTL = INVENTORY.getint("ttl", fallback=60)
+
+# Hosts and clusters are listed with the caller's credentials, so they are
+# indexed per account (API key): account -> {id -> host or cluster}
+HOSTS_BY_ID = {}
+CLUSTERS_BY_ID = {}
+# Only filled by the inventory mirror from the service account's listings
+VOLUMES_BY_VM = {}
+TAGS_BY_NAME = {}
+
+# (index name, account) -> time of the last full load
+REFRESHED = {}
+
+def is_stale(index: str, account: str) -> bool:
+    """
+    Whether a fully loaded index of the account is older than the inventory TTL.
+    """
+    return time.time() - REFRESHED.get((index, account), 0.0) > INVENTORY_TTL
+
+def index_hosts(hosts: list, account: str):
+    """
+    Replace the host index of the account with a full listHosts result.
+    """
+    HOSTS_BY_ID[account] = {h.get("id"): h for h in hosts}
+    REFRESHED[("hosts", account)] = time.time()
+
+def index_clusters(clusters: list, account: str):
+    """
+    Replace the cluster index of the account with a full listClusters result.
+    """
+    CLUSTERS_BY_ID[account] = {c.get("id"): c for c in clusters}
+    REFRESHED[("clusters", account)] = time.time()
+
+def group_volumes(volumes) -> dict:
+    """
+    Group volumes by the VM they are attached to.
+    """
+    by_vm = {}
+    for volume in volumes:
+        owner = volume.get("virtualmachineid")
+        if owner:
+            by_vm.setdefault(owner, []).append(volume)
+    return by_vm
+
+def index_volumes(volumes: list, vm_id: str = None) -> dict:
+    """
+    Index volumes listed by the inventory mirror by the VM they are attached
+    to and return the grouping. With vm_id, only the volume list of that VM
+    is replaced.
+    """
+    if vm_id is not None:
+        VOLUMES_BY_VM[vm_id] = list(volumes)
+        return {vm_id: VOLUMES_BY_VM[vm_id]}
+
+    by_vm = group_volumes(volumes)
+    VOLUMES_BY_VM.clear()
+    VOLUMES_BY_VM.update(by_vm)
+    return by_vm
+
+def index_tags(tags: list):
+    """
+    Index the oVirt tag definitions by name.
+    """
+    TAGS_BY_NAME.clear()
+    TAGS_BY_NAME.update((t.get("name"), t) for t in tags)
+
+def get_tag(name: str):
+    """
+    Return the oVirt tag definition with the given name, if any.
+    """
+    return TAGS_BY_NAME.get(name)
+
+async def refresh_hosts(request: Request, force: bool = False) -> dict:
+    """
+    Reload the routing hosts the caller can see when its index is stale.
+    """
+    account = account_key(request)
+    if force or is_stale("hosts", account):
+        data = await cs_request(request, "listHosts", {"type": "Routing"})
+        index_hosts(data["listhostsresponse"].get("host", []), account)
+    return HOSTS_BY_ID[account]
+
+async def refresh_clusters(request: Request, force: bool = False) -> dict:
+    """
+    Reload the clusters the caller can see when its index is stale.
+    """
+    account = account_key(request)
+    if force or is_stale("clusters", account):
+        data = await cs_request(request, "listClusters", {})
+        index_clusters(data["listclustersresponse"].get("cluster", []), account)
+    return CLUSTERS_BY_ID[account]
+
+async def get_host(request: Request, host_id: str):
+    """
+    Return a host by id from the index, asking CloudStack for hosts not indexed yet.
+    """
+    if not host_id:
+        return None
+
+    hosts_by_id = await refresh_hosts(request)
+    host = hosts_by_id.get(host_id)
+    if host is None:
+        data = await cs_request(request, "listHosts", {"id": host_id})
+        hosts = data["listhostsresponse"].get("host", [])
+        if hosts:
+            host = hosts[0]
+            hosts_by_id[host_id] = host
+    return host
+
+async def get_cluster(request: Request, cluster_id: str):
+    """
+    Return a cluster by id from the index.
+    """
+    if not cluster_id:
+        return None
+    return (await refresh_clusters(request)).get(cluster_id)
@@ -0,0 +1,253 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from app.cloudstack.client import cs_request, cs_list_all, account_key
+from app.config import CLOUDSTACK, INVENTORY
+from app.state import inventory
+from app.utils.logging_config import logger
+
+# =========================
+# Inventory mirror settings
+# =========================
+# The mirror is an optional, admin-scoped copy of the VMs, volumes and hosts,
+# loaded once at startup and kept up to date from CloudStack events. It is
+# read with the [cloudstack] apikey/secretkey service account and only served
+# to callers using that account; everyone else is answered from CloudStack.
+
+MIRROR_ENABLED = INVENTORY.getboolean("mirror", fallback=False)
+# Seconds between two listEvents polls
+POLL_INTERVAL = INVENTORY.getint("poll_interval", fallback=10)
+# Mirror data older than this is not served, requests go to CloudStack instead
+MAX_STALENESS = INVENTORY.getint("max_staleness", fallback=60)
+# Seconds between two full reloads, which also catch changes without events
+FULL_SYNC_INTERVAL = INVENTORY.getint("full_sync_interval", fallback=3600)
+
+SERVICE_APIKEY = CLOUDSTACK.get("apikey", fallback="")
+SERVICE_SECRETKEY = CLOUDSTACK.get("secretkey", fallback="")
+
+# Events are polled from the creation time of the newest event seen, which is
+# in the management server's time zone as listEvents expects; the poll window
+# overlaps by this many seconds and events are de-duplicated by id
+EVENT_OVERLAP = 60
+
+MIRROR = {
+    "vms": {},          # vm id -> CloudStack VM
+    "volumes": {},      # volume id -> CloudStack volume
+    "hosts": {},        # host id -> CloudStack routing host
+    "loaded": 0.0,      # time of the last full load
+    "synced": 0.0,      # time of the last successful load or poll
+    "since": None,      # creation time of the newest event seen
+    "seen": set(),      # event ids handled in the current overlap window
+}
+
+# Event type prefixes and which resources they invalidate
+EVENTS_PAGE_SIZE = 500
+VM_EVENTS = ("VM.", "NIC.")
+VOLUME_EVENTS = ("VOLUME.",)
+HOST_EVENTS = ("HOST.", "MAINT.")
+
+_sync_task = None
+
+def service_request():
+    """
+    Request-like object that makes cs_request sign with the service account keys.
+    """
+    return SimpleNamespace(state=SimpleNamespace(
+        token_info={"apikey": SERVICE_APIKEY, "secretkey": SERVICE_SECRETKEY}
+    ))
+
+def is_fresh(request) -> bool:
+    """
+    Whether the mirror is enabled, loaded and recent enough to be served to
+    the caller. It holds the service account's view, so it is only served to
+    callers signing with the service account keys.
+    """
+    if not (MIRROR_ENABLED and MIRROR["loaded"] > 0 and time.time() - MIRROR["synced"] <= MAX_STALENESS):
+        return False
+    try:
+        return account_key(request) == SERVICE_APIKEY
+    except ValueError:
+        return False
+
+def mirrored_vms() -> list:
+    return list(MIRROR["vms"].values())
+
+def mirrored_volumes() -> list:
+    return list(MIRROR["volumes"].values())
+
+def mirrored_hosts() -> list:
+    return list(MIRROR["hosts"].values())
+
+# =========================
+# Loading
+# =========================
+
+async def _list(command: str, params: dict, response: str, item: str) -> list:
+    data = await cs_request(service_request(), command, params)
+    return data[response].get(item, [])
+
+async def _list_all(command: str, params: dict, response: str, item: str) -> list:
+    return await cs_list_all(service_request(), command, params, response, item)
+
+def _event_time(event: dict):
+    """
+    Creation time of an event, e.g. 2024-05-01T10:00:00+0200, None if missing.
+    """
+    try:
+        return datetime.strptime(event.get("created") or "", "%Y-%m-%dT%H:%M:%S%z")
+    except ValueError:
+        return None
+
+def _newest_event_time(events: list):
+    times = [t for t in map(_event_time, events) if t]
+    return max(times) if times else None
+
+async def full_load():
+    """
+    Load all VMs, volumes and hosts from CloudStack.
+    """
+    # Events created while loading are applied by the next poll
+    latest = await _list("listEvents", {"pagesize": 1, "page": 1}, "listeventsresponse", "event")
+    since = _newest_event_time(latest)
+    vms = await _list_all("listVirtualMachines", {}, "listvirtualmachinesresponse", "virtualmachine")
+    volumes = await _list_all("listVolumes", {}, "listvolumesresponse", "volume")
+    hosts = await _list_all("listHosts", {"type": "Routing"}, "listhostsresponse", "host")
+
+    MIRROR["vms"] = {vm["id"]: vm for vm in vms}
+    MIRROR["volumes"] = {vol["id"]: vol for vol in volumes}
+    MIRROR["hosts"] = {host["id"]: host for host in hosts}
+    inventory.index_volumes(volumes)
+
+    MIRROR["loaded"] = MIRROR["synced"] = time.time()
+    MIRROR["since"] = since
+    MIRROR["seen"].clear()
+    logger.info(f"Inventory mirror loaded: {len(vms)} VMs, {len(volumes)} volumes, {len(hosts)} hosts")
+
+async def _refresh_vm(vm_id: str):
+    vms = await _list("listVirtualMachines", {"id": vm_id}, "listvirtualmachinesresponse", "virtualmachine")
+    if vms:
+        MIRROR["vms"][vm_id] = vms[0]
+    else:
+        MIRROR["vms"].pop(vm_id, None)
+
+    # VM events also cover volumes created, attached or removed with the VM
+    volumes = await _list("listVolumes", {"virtualmachineid": vm_id}, "listvolumesresponse", "volume")
+    for vol_id in [i for i, v in MIRROR["volumes"].items() if v.get("virtualmachineid") == vm_id]:
+        MIRROR["volumes"].pop(vol_id)
+    MIRROR["volumes"].update((vol["id"], vol) for vol in volumes)
+    inventory.index_volumes(volumes, vm_id)
+
+async def _refresh_volume(volume_id: str):
+    volumes = await _list("listVolumes", {"id": volume_id}, "listvolumesresponse", "volume")
+    previous = MIRROR["volumes"].pop(volume_id, None)
+    if volumes:
+        MIRROR["volumes"][volume_id] = volumes[0]
+
+    for vm_id in {(previous or {}).get("virtualmachineid"), volumes[0].get("virtualmachineid") if volumes else None}:
+        if vm_id:
+            inventory.index_volumes(
+                [v for v in MIRROR["volumes"].values() if v.get("virtualmachineid") == vm_id], vm_id)
+
+async def _refresh_hosts():
+    hosts = await _list_all("listHosts", {"type": "Routing"}, "listhostsresponse", "host")
+    MIRROR["hosts"] = {host["id"]: host for host in hosts}
+
+# =========================
+# Event polling
+# =========================
+
+async def poll_events():
+    """
+    Apply the CloudStack events since the last poll to the mirror.
+    """
+    params = {"pagesize": EVENTS_PAGE_SIZE, "page": 1}
+    # Without a cursor the cloud had no events at the last load, so all are new
+    if MIRROR["since"]:
+        since = MIRROR["since"] - timedelta(seconds=EVENT_OVERLAP)
+        params["startdate"] = since.strftime("%Y-%m-%d %H:%M:%S")
+    events = await _list("listEvents", params, "listeventsresponse", "event")
+
+    vm_ids, volume_ids = set(), set()
+    reload_hosts = full_reload = False
+    seen = set()
+    for event in events:
+        seen.add(event.get("id"))
+        if event.get("id") in MIRROR["seen"] or event.get("state") not in ("Completed", None):
+            continue
+
+        event_type = event.get("type", "")
+        resource_id = event.get("resourceid")
+        resource_type = event.get("resourcetype", "")
+        if event_type.startswith(HOST_EVENTS):
+            reload_hosts = True
+        elif not event_type.startswith(VM_EVENTS + VOLUME_EVENTS):
+            continue
+        elif not resource_id:
+            # Older CloudStack versions do not report the resource of an event
+            full_reload = True
+        elif resource_type in ("VirtualMachine", "UserVm") or (not resource_type and event_type.startswith(VM_EVENTS)):
+            vm_ids.add(resource_id)
+        elif resource_type == "Volume" or (not resource_type and event_type.startswith(VOLUME_EVENTS)):
+            volume_ids.add(resource_id)
+
+    # A full page may have missed events, reload everything instead
+    if full_reload or len(events) >= EVENTS_PAGE_SIZE:
+        await full_load()
+        return
+
+    for vm_id in vm_ids:
+        await _refresh_vm(vm_id)
+    # Volumes of refreshed VMs are already up to date
+    covered = {v["id"] for v in MIRROR["volumes"].values() if v.get("virtualmachineid") in vm_ids}
+    for volume_id in volume_ids - covered:
+        await _refresh_volume(volume_id)
+    if reload_hosts:
+        await _refresh_hosts()
+
+    MIRROR["since"] = _newest_event_time(events) or MIRROR["since"]
+    MIRROR["seen"] = seen
+    MIRROR["synced"] = time.time()
+    if vm_ids or volume_ids or reload_hosts:
+        logger.debug(f"Inventory mirror updated: {len(vm_ids)} VMs, {len(volume_ids)} volumes, hosts reloaded: {reload_hosts}")
+
+async def sync_loop():
+    """
+    Keep the mirror up to date until cancelled.
+    """
+    while True:
+        try:
+            if not MIRROR["loaded"] or time.time() - MIRROR["loaded"] > FULL_SYNC_INTERVAL:
+                await full_load()
+            else:
+                await poll_events()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # The mirror goes stale and requests fall back to CloudStack
+            logger.error(f"Inventory mirror sync failed: {str(e)}")
+        await asyncio.sleep(POLL_INTERVAL)
+
+def start_sync():
+    """
+    Start the background mirror if it is enabled in [inventory].
+    """
+    global _sync_task
+    if not MIRROR_ENABLED:
+        return
+    if not SERVICE_APIKEY or not SERVICE_SECRETKEY:
+        logger.error("Inventory mirror requires apikey and secretkey in [cloudstack], not starting it")
+        return
+    _sync_task = asyncio.create_task(sync_loop())
+    logger.info(f"Inventory mirror started (poll every {POLL_INTERVAL}s, max staleness {MAX_STALENESS}s)")
+
+async def stop_sync():
+    global _sync_task
+    if _sync_task:
+        _sync_task.cancel()
+        try:
+            await _sync_task
+        except asyncio.CancelledError:
+            pass
+        _sync_task = None
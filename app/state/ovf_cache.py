@@ -0,0 +1,61 @@
+from collections import OrderedDict
+
+# Maximum number of VMs with a cached OVF document
+OVF_CACHE_SIZE = 1024
+
+# vm id -> {"key": fingerprint, "data": OVF XML template}, least recently used first
+OVF_CACHE = OrderedDict()
+
+# Stands for the time of the response in cached OVF templates, so export,
+# creation and boot dates are filled in per response instead of frozen
+OVF_NOW = "{{ovf-now}}"
+
+# Fields generate_vm_xml() reads, a change of any of them changes the OVF
+VM_FIELDS = (
+    "id", "displayname", "instancename", "ostype", "account", "domain", "domainid",
+    "projectid", "userid", "zoneid", "templateid", "serviceofferingid", "cpunumber", "memory",
+)
+VOLUME_FIELDS = ("id", "name", "displaytext", "size", "storageid", "path", "templateid")
+NIC_FIELDS = ("id", "macaddress", "networkid", "networkname")
+
+def ovf_cache_key(vm: dict, volumes: list) -> tuple:
+    """
+    Fingerprint of everything the OVF of a VM is derived from: the fields of
+    the VM, its volumes and its NICs that generate_vm_xml() reads, in order.
+    """
+    return (
+        tuple(vm.get(f) for f in VM_FIELDS),
+        tuple(tuple(v.get(f) for f in VOLUME_FIELDS) for v in volumes),
+        tuple(tuple(n.get(f) for f in NIC_FIELDS) for n in vm.get("nic", [])),
+    )
+
+def get_ovf(vm_id: str, key: tuple):
+    """
+    Return the cached OVF template of a VM if it was generated for the same fingerprint.
+    """
+    entry = OVF_CACHE.get(vm_id)
+    if entry is None or entry["key"] != key:
+        return None
+    OVF_CACHE.move_to_end(vm_id)
+    return entry["data"]
+
+def store_ovf(vm_id: str, key: tuple, data: str):
+    """
+    Cache the OVF template of a VM, evicting the least recently used entries.
+    """
+    OVF_CACHE[vm_id] = {"key": key, "data": data}
+    OVF_CACHE.move_to_end(vm_id)
+    while len(OVF_CACHE) > OVF_CACHE_SIZE:
+        OVF_CACHE.popitem(last=False)
+
+def invalidate_ovf(vm_id: str):
+    """
+    Drop the cached OVF document of a VM, e.g. after it was updated.
+    """
+    OVF_CACHE.pop(vm_id, None)
+
+def render_ovf(template: str, now: str) -> str:
+    """
+    The OVF document of a cached template at the given time.
+    """
+    return template.replace(OVF_NOW, now)
@@ -0,0 +1,194 @@
+import re
+from fnmatch import fnmatchcase
+
+# One "field=value" / "field!=value" term, the value may be quoted
+SEARCH_TERM = re.compile(r'\s*([A-Za-z_][\w.]*)\s*(!=|=)\s*(?:"([^"]*)"|(\S+))')
+SEARCH_CONNECTOR = re.compile(r'\s+(and|or)\s+|\s+(?=[A-Za-z_][\w.]*\s*!?=)', re.IGNORECASE)
+SEARCH_SORTBY = re.compile(r'\s*sortby\s+([\w.]+)(?:\s+(asc|desc))?\s*$', re.IGNORECASE)
+
+# oVirt VM status -> CloudStack VM states (see VM_STATUS in app/ovirtapi/vm.py)
+OVIRT_STATUS_TO_CS = {
+    "up": ("Running",),
+    "down": ("Stopped", "Error", "Shutdown", "Destroyed", "Expunging"),
+    "powering_down": ("Stopping",),
+    "powering_up": ("Starting",),
+    "migrating": ("Migrating",),
+    "restoring_state": ("Restoring",),
+    "unknown": ("Unknown",),
+}
+
+VM_SEARCH_FIELDS = ("name", "id", "status", "host", "tag")
+
+# CloudStack instance names, i-{account id}-{vm id}-{instance.name}
+INSTANCE_NAME = re.compile(r"i-\d+-\d+-", re.IGNORECASE)
+
+# CloudStack resource tag key used for oVirt tags (see app/ovirtapi/tags.py)
+TAG_KEY = "veeam_tag"
+
+def parse_search(search: str):
+    """
+    Parse an oVirt search expression such as 'name=vm* and status=up sortby name desc'.
+
+    Returns (groups, sortby) where groups is a list of OR-ed groups, each a list
+    of AND-ed (field, operator, value) terms, and sortby is (field, descending) or None.
+    Raises ValueError for expressions that cannot be parsed.
+    """
+    text = search.strip()
+    if text[:4].lower() == "vms:":
+        text = text[4:]
+
+    sortby = None
+    match = SEARCH_SORTBY.search(text)
+    if match:
+        sortby = (match.group(1).lower(), (match.group(2) or "asc").lower() == "desc")
+        text = text[:match.start()]
+
+    groups = [[]]
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = SEARCH_TERM.match(text, pos)
+        if not match:
+            raise ValueError(f"Invalid search expression near '{text[pos:]}'")
+        field, op, quoted, value = match.groups()
+        groups[-1].append((field.lower(), op, quoted if quoted is not None else value))
+        pos = match.end()
+        if pos >= len(text):
+            break
+        connector = SEARCH_CONNECTOR.match(text, pos)
+        if not connector:
+            raise ValueError(f"Invalid search expression near '{text[pos:]}'")
+        if (connector.group(1) or "").lower() == "or":
+            groups.append([])
+        pos = connector.end()
+
+    groups = [group for group in groups if group]
+    for group in groups:
+        for field, _, _ in group:
+            if field not in VM_SEARCH_FIELDS:
+                raise ValueError(f"Unsupported search field '{field}'")
+    return groups, sortby
+
+
+class VmSearch:
+    """
+    Translates an oVirt VM search expression and 'max' into listVirtualMachines
+    filter parameters, keeping the terms CloudStack cannot express to be
+    evaluated in memory on the returned VMs.
+    """
+
+    def __init__(self, search: str = None, max_results: int = None, hosts: list = None):
+        self.groups, self.sortby = parse_search(search) if search else ([], None)
+        self.max_results = max_results
+        self.hosts = hosts or []
+        self.params = {}
+        self.residual = self.groups
+        self._translate()
+
+    def _translate(self):
+        # Only a single AND-ed group can be pushed down to CloudStack
+        if len(self.groups) == 1:
+            residual = []
+            for term in self.groups[0]:
+                if not self._push_down(term):
+                    residual.append(term)
+            self.residual = [residual] if residual else []
+
+        if self.max_results and not self.residual and not self.sortby:
+            self.params["page"] = 1
+            self.params["pagesize"] = self.max_results
+
+    def _push_down(self, term) -> bool:
+        """
+        Add CloudStack filter parameters for a term.
+        Returns True when CloudStack evaluates the term exactly.
+        """
+        field, op, value = term
+        if op != "=":
+            return False
+        wildcard = "*" in value
+
+        if field == "id" and not wildcard:
+            self.params["id"] = value
+            return True
+
+        if field == "name":
+            # keyword is a substring match over the display name and host name,
+            # and only for admins over the instance name. Narrow the listing
+            # with it only when the term cannot match an instance name (no
+            # wildcard, not shaped like one), and keep the exact comparison in
+            # memory
+            if not wildcard and not INSTANCE_NAME.match(value) and "keyword" not in self.params:
+                self.params["keyword"] = value
+            return False
+
+        if field == "status":
+            states = OVIRT_STATUS_TO_CS.get(value.lower(), ())
+            if len(states) == 1 and "state" not in self.params:
+                self.params["state"] = states[0]
+                return True
+            return False
+
+        if field == "host" and not wildcard and "hostid" not in self.params:
+            host_ids = [h.get("id") for h in self.hosts if value in (h.get("id"), h.get("name"))]
+            if len(host_ids) == 1:
+                self.params["hostid"] = host_ids[0]
+                return True
+            return False
+
+        if field == "tag" and not wildcard and "tags[0].key" not in self.params:
+            self.params["tags[0].key"] = TAG_KEY
+            self.params["tags[0].value"] = value
+            return True
+
+        return False
+
+    @staticmethod
+    def _term_matches(vm: dict, term) -> bool:
+        field, op, value = term
+        pattern = value.lower()
+
+        def like(candidate) -> bool:
+            return candidate is not None and fnmatchcase(str(candidate).lower(), pattern)
+
+        if field == "name":
+            matched = like(vm.get("instancename")) or like(vm.get("name"))
+        elif field == "id":
+            matched = like(vm.get("id"))
+        elif field == "status":
+            states = OVIRT_STATUS_TO_CS.get(pattern, (value,))
+            matched = vm.get("state", "").lower() in (s.lower() for s in states)
+        elif field == "host":
+            matched = like(vm.get("hostname")) or like(vm.get("hostid"))
+        elif field == "tag":
+            matched = any(t.get("key") == TAG_KEY and like(t.get("value")) for t in vm.get("tags", []))
+        else:
+            matched = False
+
+        return matched if op == "=" else not matched
+
+    def matches(self, vm: dict, groups: list = None) -> bool:
+        """
+        Evaluate the terms CloudStack could not filter (or the given groups) on a CloudStack VM dict.
+        """
+        groups = self.residual if groups is None else groups
+        if not groups:
+            return True
+        return any(all(self._term_matches(vm, term) for term in group) for group in groups)
+
+    def filter(self, vms: list, local: bool = False) -> list:
+        """
+        Apply the in-memory filter, sorting and 'max' to the VMs returned by CloudStack.
+        With local, the whole search is evaluated, for VMs not filtered by CloudStack.
+        """
+        groups = self.groups if local else self.residual
+        result = [vm for vm in vms if self.matches(vm, groups)]
+
+        if self.sortby:
+            field, descending = self.sortby
+            key = {"name": "instancename", "status": "state", "host": "hostname"}.get(field, field)
+            result.sort(key=lambda vm: str(vm.get(key) or "").lower(), reverse=descending)
+
+        if self.max_results is not None and self.max_results >= 0:
+            result = result[:self.max_results]
+        return result
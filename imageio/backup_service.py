@@ -1,26 +1,37 @@
+import asyncio
 import os
 import json
-import subprocess
 import datetime
 import xml.etree.ElementTree as ET
 import libvirt
 import nbd
 import uuid
 import time
+from array import array
+from contextlib import nullcontext
+from itertools import chain
+from anyio import from_thread
 from fastapi import APIRouter, Header, HTTPException, Request
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from app.security.certs import get_default_ip
 from imageio.config import IMAGEIO
-from imageio.utils import check_internal_auth
+from imageio.utils import check_internal_auth, accepts_gzip, gzip_stream, range_response
 from imageio.logging_imageio import logger
+from imageio.bitmaps import run_bitmaps
+from imageio.meta_store import meta_store, meta_lock
+from imageio.scheduler import backup_slots, limit_stream
+from imageio.libvirt_conn import lookup_domain, backup_begin, has_checkpoint, redefine_checkpoint, delete_checkpoint, abort_job, job_started, get_job
+from imageio.nbd_pool import MAX_WRITERS, get_pool, close_image_pools
+from imageio.nbd_server import ensure_server, running_server, use_server, stop_image_servers, wait_for_nbd_async
+from imageio.nbd_stream import sparse_read_range
+from imageio.upload_stream import upload_to_nbd, zero_nbd, flush_nbd
+from imageio.extents import ExtentMap, stream_json, get_extent_map, drop_image_extents, segments
 
 
 # Import the internal token
 INTERNAL_TOKEN = IMAGEIO.get("internal_token", None)
 
-# In-memory cache for NBD processes
-nbd_processes = {}
 
 
 # =============================
@@ -28,12 +39,17 @@ nbd_processes = {}
 # =============================
 
 BACKUP_ROOT = "/backup"
-META_ROOT = "/backup/meta"
 CLUSTER_SIZE = 65536
 KEEP_CHECKPOINTS = 1
 
 CHUNK_SIZE = 2 * 1024 * 1024
 
+# Seconds to wait for the NBD server of a libvirt backup job
+BACKUP_START_TIMEOUT = 30
+
+# Largest range asked in one NBD block status request
+BLOCK_STATUS_MAX = 2 ** 31
+
 backup_router = APIRouter()
 
 # =============================
@@ -50,18 +66,15 @@ class BackupStatusResponse(BaseModel):
     vm_name: str
     backup_in_progress: bool
     job_info: str
+    job_state: str = ""
 
 # =============================
 # Metadata helpers
 # =============================
 
-def meta_path(vm):
-    return os.path.join(META_ROOT, f"{vm}.json")
-
-
 def load_meta(vm):
-    path = meta_path(vm)
-    if not os.path.exists(path):
+    meta = meta_store.load(vm)
+    if meta is None:
         return {
             "mode": None,
             "last_checkpoint": None,
@@ -70,16 +83,22 @@ def load_meta(vm):
             "cluster_size": CLUSTER_SIZE,
             "disks": {}
         }
-    with open(path) as f:
-        return json.load(f)
+    return meta
 
 
-def save_meta(vm, meta):
-    os.makedirs(META_ROOT, exist_ok=True)
-    tmp = meta_path(vm) + ".tmp"
-    with open(tmp, "w") as f:
-        json.dump(meta, f, indent=2)
-    os.replace(tmp, meta_path(vm))
+def save_meta(vm, meta, wait=True):
+    meta_store.save(vm, meta, wait)
+
+async def set_meta_context(vm, context):
+    """
+    Record the extents context the downloads of the VM follow, under the
+    metadata lock of the VM so backups and finalizes do not lose it.
+    """
+    async with meta_lock(vm):
+        meta = load_meta(vm)
+        if meta.get("context") != context:
+            meta["context"] = context
+            save_meta(vm, meta, wait=False)
 
 
 # =============================
@@ -87,15 +106,10 @@ def save_meta(vm, meta):
 # =============================
 
 def get_vm(vm):
-    conn = libvirt.open(None)
-    try:
-        dom = conn.lookupByName(vm)
-        return dom, get_vm_state(dom)
-    except libvirt.libvirtError as e:
-        logger.error(f"Error looking up VM {vm}: {e}")
+    dom = lookup_domain(vm)
+    if dom is None:
         return None, "stopped"
-    finally:
-        conn.close()
+    return dom, get_vm_state(dom)
 
 def get_vm_state(dom):
     state, _ = dom.state()
@@ -122,8 +136,8 @@ def get_disk_paths(dom):
 # Full backup
 # =============================
 
-def full_backup_running_vm(vm, dom):
-    disk_paths = get_disk_paths(dom)
+async def full_backup_running_vm(vm, dom):
+    disk_paths = await asyncio.to_thread(get_disk_paths, dom)
     vm_dir = os.path.join(BACKUP_ROOT, vm)
     os.makedirs(vm_dir, exist_ok=True)
 
@@ -134,13 +148,13 @@ def full_backup_running_vm(vm, dom):
     # Generate backup XML configuration for full backup
     backup_xml = generate_backup_xml(vm, disk_paths, vm_dir, None, checkpoint_name)
 
-    run_virsh_backup_begin(vm, checkpoint_name, backup_xml, checkpoint_xml)
+    await start_backup_job(vm, dom, checkpoint_name, backup_xml, checkpoint_xml)
 
     return checkpoint_name
 
 
 # =============================
-# Running VM incremental (virsh backup-begin)
+# Running VM incremental (libvirt backup job)
 # =============================
 
 def generate_backup_xml(vm, disk_paths, vm_dir, checkpoint_id=None, new_checkpoint_name=None):
@@ -170,28 +184,14 @@ def generate_backup_xml(vm, disk_paths, vm_dir, checkpoint_id=None, new_checkpoi
     return ET.tostring(root).decode()
 
 
-def run_virsh_backup_begin(vm, checkpoint_name, backup_xml, checkpoint_xml):
-    vm_dir = os.path.join(BACKUP_ROOT, vm)
-    os.makedirs(vm_dir, exist_ok=True)
-
-    # Create backup.xml and checkpoint.xml in vm_dir
-    backup_xml_file = os.path.join(vm_dir, f"{checkpoint_name}-backup.xml")
-    checkpont_xml_file = os.path.join(vm_dir, f"{checkpoint_name}-checkpoint.xml")
-
-    with open(backup_xml_file, "w") as f:
-        f.write(backup_xml)
-    with open(checkpont_xml_file, "w") as f:
-        f.write(checkpoint_xml)
-
-
-    # Execute virsh backup-begin command for full or incremental backup
-    cmd = [
-        "virsh", "backup-begin", vm,
-        "--backupxml", backup_xml_file,
-        "--checkpointxml", checkpont_xml_file
-    ]
-    proc = subprocess.Popen(cmd)
-    wait_for_socket(f"/tmp/nbd-{vm}-{checkpoint_name}.sock")
+async def start_backup_job(vm, dom, checkpoint_name, backup_xml, checkpoint_xml):
+    """
+    Start the libvirt backup job of a running VM and wait for its NBD server.
+    """
+    logger.debug(f"Starting backup job for {vm}: {backup_xml} {checkpoint_xml}")
+    await asyncio.to_thread(backup_begin, dom, backup_xml, checkpoint_xml)
+    job_started(vm)
+    await wait_for_nbd_async(f"/tmp/nbd-{vm}-{checkpoint_name}.sock", BACKUP_START_TIMEOUT, metric="backup_nbd_ready_seconds")
 
 
 # =============================
@@ -201,49 +201,30 @@ def run_virsh_backup_begin(vm, checkpoint_name, backup_xml, checkpoint_xml):
 def check_backup_job_status(vm_name: str) -> dict:
     """
     Check if a backup job is currently running for the given VM.
-    Uses virsh domjobinfo command to determine backup status.
+    Looks the job up in the table kept up to date by libvirt job events.
     Returns a dictionary with backup status information.
     """
 
     # Since the backup job exposes the VM via NBD server, this returns False always, which means the VM is ready for veeam backup
 
-    try:
-        # Run virsh domjobinfo command
-        result = subprocess.run(
-            ["virsh", "domjobinfo", vm_name],
-            capture_output=True,
-            text=True,
-            check=False
-        )
-        
-        # If command fails or returns empty output, no backup job is running
-        if result.returncode != 0 or not result.stdout.strip():
-            return {
-                "backup_in_progress": False,
-                "job_info": ""
-            }
-        
-        job_info = result.stdout.strip()
-
-        # Loop through lines and check for both keywords
-        backup_in_progress = False
-        for line in job_info.split('\n'):
-            if "Operation:" in line and "Backup" in line:
-                backup_in_progress = False
-                break
+    job = get_job(vm_name)
 
-        return {
-            "backup_in_progress": backup_in_progress,
-            "job_info": job_info
-        }
-        
-    except Exception as e:
-        # If any error occurs, assume no backup job is running
+    # No job was started
+    if job is None:
         return {
             "backup_in_progress": False,
-            "job_info": f"Error checking backup status: {str(e)}"
+            "job_info": "",
+            "job_state": ""
         }
 
+    job_info = "\n".join(f"{key}: {value}" for key, value in job.items() if value)
+
+    return {
+        "backup_in_progress": False,
+        "job_info": job_info,
+        "job_state": job["state"]
+    }
+
 # =============================
 # FastAPI: Backup endpoint
 # =============================
@@ -263,11 +244,17 @@ async def backup_vm(vm: str, request: Request):
 
     volumes = payload["volumes"]
 
+    # One backup or finalize of a VM at a time, each changes its metadata,
+    # and at most max_backups on the host
+    async with meta_lock(vm), backup_slots.slot_async(vm):
+        return await run_backup(vm, checkpoint_id, volumes)
+
+async def run_backup(vm, checkpoint_id, volumes):
     meta = load_meta(vm)
-    dom, state = get_vm(vm)
+    dom, state = await asyncio.to_thread(get_vm, vm)
 
     if dom:
-        disk_paths = get_disk_paths(dom)
+        disk_paths = await asyncio.to_thread(get_disk_paths, dom)
     else:
         disk_paths = {}
 
@@ -281,7 +268,7 @@ async def backup_vm(vm: str, request: Request):
     # FULL BACKUP of Running VM
     # -------------------------
     if not checkpoint_id and state == "running":
-        checkpoint_name = full_backup_running_vm(vm, dom)
+        checkpoint_name = await full_backup_running_vm(vm, dom)
 
         meta["previous_mode"] = meta["mode"]
         meta["previous_checkpoint"] = meta["last_checkpoint"]
@@ -302,7 +289,7 @@ async def backup_vm(vm: str, request: Request):
         if state == "running":
             meta["last_checkpoint"] = checkpoint_name
 
-        save_meta(vm, meta)
+        await asyncio.to_thread(save_meta, vm, meta)
 
         return BackupResponse(
             vm_name=vm,
@@ -317,33 +304,15 @@ async def backup_vm(vm: str, request: Request):
         # -------------------------
         checkpoint_name = f"bitmap-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
 
-        # Create bitmap on images of stopped VM
-        for volume in volumes:
-            volume_path = f"/mnt/{volume['storageid']}/{volume['path']}"
-            if os.path.exists(volume_path):
-                # create bitmap using "qemu-img bitmap" command
-                cmd = [
-                    "qemu-img", "bitmap",
-                    "--add",
-                    volume_path,
-                    checkpoint_name
-                ]
-                subprocess.run(cmd, check=True)
-                logger.info(f"Created bitmap for full backup for {volume_path} as {checkpoint_name}")
-
-                if meta["last_checkpoint"]:
-                    try:
-                        # remove last bitmap or checkpoint if exists
-                        cmd = [
-                            "qemu-img", "bitmap",
-                            "--remove",
-                            volume_path,
-                            meta["last_checkpoint"]
-                        ]
-                        subprocess.run(cmd, check=True)
-                        logger.info(f"Removed last bitmap {meta["previous_checkpoint"]} from {volume_path}")
-                    except Exception as e:
-                        logger.error(f"Error removing previous bitmap {meta['previous_checkpoint']} from {volume_path}: {e}")
+        # Create bitmap on images of stopped VM, all disks at once
+        volume_paths = [p for p in (f"/mnt/{v['storageid']}/{v['path']}" for v in volumes) if os.path.exists(p)]
+        await add_bitmaps(volume_paths, checkpoint_name)
+        logger.info(f"Created bitmap for full backup for {volume_paths} as {checkpoint_name}")
+
+        if meta["last_checkpoint"]:
+            # remove last bitmap or checkpoint if exists, errors are only logged
+            await run_bitmaps("remove", volume_paths, meta["last_checkpoint"])
+            logger.info(f"Removed last bitmap {meta['last_checkpoint']} from {volume_paths}")
 
 
         meta = {
@@ -364,7 +333,7 @@ async def backup_vm(vm: str, request: Request):
                 "file_path": volume_path
             }
 
-        save_meta(vm, meta)
+        await asyncio.to_thread(save_meta, vm, meta)
 
         return BackupResponse(
             vm_name=vm,
@@ -383,31 +352,22 @@ async def backup_vm(vm: str, request: Request):
                 detail=f"Checkpoint mismatch: expected {meta.get('last_checkpoint')}, got {checkpoint_id}"
             )
 
-        # ---- Running VM: virsh backup-begin ----
+        # ---- Running VM: libvirt backup job ----
         if state == "running":
             if meta.get("last_checkpoint"):
                 # check if the checkpoint exists
-                cmd = ["virsh", "checkpoint-list", vm]
-                output = subprocess.run(cmd, check=True, capture_output=True, text=True)
-                if meta["last_checkpoint"] not in output.stdout:
-                    # generate checkpoint xml with the bitmap
+                if not await asyncio.to_thread(has_checkpoint, dom, meta["last_checkpoint"]):
+                    # generate checkpoint xml with the bitmap, e.g. after the VM was stopped and started
                     previous_checkpoint_xml = generate_checkpoint_xml_from_bitmap(vm, meta["last_checkpoint"], disk_paths)
-                    # run "echo previous_checkpoint_xml | virsh checkpoint-create --xmlfile /dev/stdin --redefine"
-                    cmd = ["virsh", "checkpoint-create", vm,
-                        "--xmlfile", "/dev/stdin",
-                        "--redefine"
-                    ]
-                    subprocess.run(cmd, input=previous_checkpoint_xml, check=True, text=True)
+                    await asyncio.to_thread(redefine_checkpoint, dom, previous_checkpoint_xml)
                     logger.info(f"Created checkpoint {meta['last_checkpoint']} from bitmap")
 
-                    subprocess.run(["virsh", "checkpoint-list", vm], check=True)
-
             checkpoint_name = f"incremental-backup-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
             checkpoint_xml = f"<domaincheckpoint><name>{checkpoint_name}</name></domaincheckpoint>"
 
             backup_xml = generate_backup_xml(vm, disk_paths, vm_dir, checkpoint_id, checkpoint_name)
 
-            run_virsh_backup_begin(vm, checkpoint_name, backup_xml, checkpoint_xml)
+            await start_backup_job(vm, dom, checkpoint_name, backup_xml, checkpoint_xml)
 
             i = 0
             for disk in disk_paths.keys():
@@ -422,26 +382,20 @@ async def backup_vm(vm: str, request: Request):
             meta["previous_checkpoint"] = meta["last_checkpoint"]
             meta["mode"] = "cbt"
             meta["last_checkpoint"] = checkpoint_name
-            save_meta(vm, meta)
+            await asyncio.to_thread(save_meta, vm, meta)
 
         # ---- Stopped VM: bitmap ----
         else:
             checkpoint_name = f"bitmap-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
             # disk_paths is empty for stopped VM, use "volumes" instead
             meta["disks"] = {}
+            volume_paths = [p for p in (f"/mnt/{v['storageid']}/{v['path']}" for v in volumes) if os.path.exists(p)]
+            await add_bitmaps(volume_paths, checkpoint_name)
+            logger.info(f"Created bitmap for incremental backup for {volume_paths} as {checkpoint_name}")
+
             i = 0
             for volume in volumes:
                 volume_path = f"/mnt/{volume['storageid']}/{volume['path']}"
-                if os.path.exists(volume_path):
-                    # create new bitmap using "qemu-img bitmap" command
-                    cmd = [
-                        "qemu-img", "bitmap",
-                        "--add",
-                        volume_path,
-                        checkpoint_name
-                    ]
-                    subprocess.run(cmd, check=True)
-                    logger.info(f"Created bitmap for incremental backup for {volume_path} as {checkpoint_name}")
                 index = "disk" + str(i)
                 i += 1
                 meta["disks"][index] = {
@@ -452,7 +406,7 @@ async def backup_vm(vm: str, request: Request):
             meta["previous_checkpoint"] = meta["last_checkpoint"]
             meta["mode"] = "bitmap"
             meta["last_checkpoint"] = checkpoint_name
-            save_meta(vm, meta)
+            await asyncio.to_thread(save_meta, vm, meta)
 
         return BackupResponse(
             vm_name=vm,
@@ -467,8 +421,19 @@ async def backup_vm(vm: str, request: Request):
 
 def get_extents_for_backup(vm: str, diskpath: str, request: Request, context: str = "zero", transfer_id: str = None):
 
+    if context not in ("zero", "dirty"):
+        raise HTTPException(status_code=400, detail="Invalid context")
+
+    # The downloads of the VM follow the context of the last extents call;
+    # this runs in a worker thread, the lock is taken on the event loop
+    from_thread.run(set_meta_context, vm, context)
     meta = load_meta(vm)
-    dom, state = get_vm(vm)
+
+    # The extents of a transfer do not change, compute them once per context
+    cached = get_extent_map(transfer_id, context) if transfer_id else None
+    if cached is not None:
+        logger.debug(f"Using cached extents of image {diskpath} for transfer_id {transfer_id} and context {context}")
+        return extents_response(request, stream_json(cached))
 
     if meta["mode"] == "cbt":
         # online backup for running vm
@@ -497,21 +462,33 @@ def get_extents_for_backup(vm: str, diskpath: str, request: Request, context: st
     else:
         raise HTTPException(status_code=400, detail="Invalid backup mode")
 
-    meta["context"] = context
-    save_meta(vm, meta)
-
     logger.debug(f"Getting extents via NBD server for image {diskpath} and transfer_id {transfer_id}")
 
-    if context == "zero":
-        # Full backup
-        return get_extents_via_nbd(diskpath, socket_path=socket_path, disk_label=disk_label, context = "zero", transfer_id=transfer_id)
+    # Full backup uses the zero context, incremental backup the dirty bitmap
+    bitmap_name = meta["previous_checkpoint"] if context == "dirty" else None
+    batches = block_status_via_nbd(diskpath, bitmap_name=bitmap_name, socket_path=socket_path,
+            disk_label=disk_label, transfer_id=transfer_id)
+
+    # Connect and read the first batch now, so that NBD errors still become an
+    # error response instead of a truncated document
+    first = next(batches, None)
+    if first is not None:
+        batches = chain([first], batches)
 
-    if context == "dirty":
-        # Incremental backup
-        return get_extents_via_nbd(diskpath, bitmap_name=meta["previous_checkpoint"], socket_path=socket_path,
-                disk_label=disk_label, context = "dirty", transfer_id=transfer_id)
+    # The map is stored once complete: served again for later calls, and lets
+    # downloads skip zero extents
+    extents = ExtentMap("dirty" if bitmap_name else "zero", diskpath)
+    return extents_response(request, stream_json(extents, batches, transfer_id))
 
-    raise HTTPException(status_code=400, detail="Invalid context")
+def extents_response(request: Request, chunks) -> StreamingResponse:
+    """
+    Stream JSON extents to the client, gzip compressed when it accepts it.
+    """
+    headers = {"Vary": "Accept-Encoding"}
+    if accepts_gzip(request):
+        chunks = gzip_stream(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(chunks, media_type="application/json", headers=headers)
 
 # =============================
 # Internal method: download via NBD, used by service.py
@@ -550,98 +527,27 @@ def download_via_nbd(vm: str, diskpath: str, request: Request, transfer_id: str)
         bitmap_name = None
 
     if socket_path:
-        # NBD server is already running via "virsh backup-begin"
+        # NBD server is already running via the libvirt backup job
         logger.debug(f"Using existing NBD server for image {diskpath} with socket {socket_path}")
-        proc = None
     else:
-        socket_path = get_socket_path(diskpath, transfer_id)
-        if os.path.exists(socket_path):
-            logger.debug(f"Using existing NBD server for image {diskpath} with socket {socket_path}")
-        else:
-            socket_path, proc = create_nbd_socket(diskpath, bitmap_name=bitmap_name, transfer_id=transfer_id)
-            nbd_processes[diskpath] = proc
-            logger.debug(f"Started NBD server for image {diskpath} with socket {socket_path} and proc {proc}")
+        # Shared with the extents calls and other downloads of the same export
+        socket_path = ensure_server(diskpath, bitmap_name)
 
     if not os.path.exists(socket_path):
         raise HTTPException(status_code=404, detail=f"Socket {socket_path} not found")
 
-    conn = nbd.NBD()
-    logger.debug(f"Test: Connecting to NBD socket {socket_path}")
-    if disk_label:
-        conn.set_export_name(disk_label)
-    conn.connect_unix(socket_path)
-    logger.debug(f"Test: NBD socket {socket_path} size: {conn.get_size()}")  # conn.get_size()
-    conn.close()
-
-    def reader_via_nbd(start: int, length: int, image: str, disk_label: str = None, bitmap_name: str = None, socket_path: str = None):
-        conn = nbd.NBD()
-        try:
-            if bitmap_name:
-                # Tell NBD which bitmap to use
-                conn.add_meta_context(f"{nbd.CONTEXT_QEMU_DIRTY_BITMAP}{bitmap_name}")
-            if disk_label:
-                conn.set_export_name(disk_label)
-
-            logger.debug(f"Connecting to NBD socket {socket_path}")
-            conn.connect_unix(socket_path)
+    # Reuse the connections of this transfer across range requests
+    meta_contexts = (f"{nbd.CONTEXT_QEMU_DIRTY_BITMAP}{bitmap_name}",) if bitmap_name else ()
+    pool = get_pool(transfer_id, socket_path, disk_label, meta_contexts, image=diskpath)
 
-            offset = start
-            remaining = length
-
-            while remaining > 0:
-                chunk_len = min(CHUNK_SIZE, remaining)
-                data = conn.pread(chunk_len, offset)
-                if not data:
-                    data = b"\x00" * chunk_len
-                yield bytes(data)
-                offset += chunk_len
-                remaining -= chunk_len
-        finally:
-            conn.close()
+    def reader_via_nbd(start: int, length: int):
+        # Zero extents known from the extents call are not read, large data
+        # ranges are striped over several pooled connections
+        return limit_stream(transfer_id, sparse_read_range(pool, segments(transfer_id, start, length)), diskpath)
 
-    file_size = get_virtual_size(diskpath)
-    range_header = request.headers.get("range")
-
-    if not range_header:
-        # No range requested, return full file
-        return StreamingResponse(
-            reader_via_nbd(0, file_size, diskpath, disk_label, bitmap_name, socket_path),
-            headers={"Content-Length": str(file_size)},
-            media_type="application/octet-stream"
-        )
-
-    # Parse range header (format: "bytes=start-end")
-    try:
-        range_type, range_spec = range_header.split("=")
-        if range_type.strip().lower() != "bytes":
-            raise HTTPException(status_code=400, detail="Invalid range type")
-        
-        start_str, end_str = range_spec.split("-")
-        start = int(start_str)
-        end = int(end_str) if end_str else file_size - 1
-        
-        # Handle negative values and bounds checking
-        if start < 0 or start >= file_size:
-            raise HTTPException(status_code=416, detail="Range Not Satisfiable")
-        end = min(end, file_size - 1)
-        
-        length = end - start + 1
-        
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid range format")
-
-    headers = {
-        "Content-Range": f"bytes {start}-{start+length-1}/{file_size}/*",
-        "Content-Length": str(length),
-        "Accept-Ranges": "bytes"
-    }
-
-    return StreamingResponse(
-        reader_via_nbd(start, length, diskpath, disk_label, bitmap_name, socket_path),
-        media_type="application/octet-stream",
-        headers=headers,
-        status_code=206
-    )
+    # Asked once per transfer from the export, instead of running qemu-img
+    file_size = pool.get_size()
+    return range_response(request, file_size, reader_via_nbd)
 
 # =============================
 # Internal method: upload via NBD, used by service.py
@@ -652,52 +558,38 @@ async def upload_via_nbd(diskpath: str, request: Request, transfer_id: str):
     Set up a writable NBD server for the qcow2 file at diskpath,
     then stream data from the request and write it via NBD.
     """
-    # Parse content-range header: "bytes start-end/total_size"
-    range_header = request.headers.get("content-range")
-    if range_header:
-        _, range_part = range_header.split(" ")
-        range_and_size = range_part.split("/")
-        range_only = range_and_size[0]
-        start_s, end_s = range_only.split("-")
-        start = int(start_s)
-    else:
-        start = 0
+    pool = await writable_pool(diskpath, transfer_id)
+    await upload_to_nbd(pool, request, transfer_id)
 
-    # Get or create a writable NBD socket
-    socket_path = get_socket_path(diskpath, transfer_id)
-    if os.path.exists(socket_path):
-        logger.debug(f"Using existing writable NBD server for image {diskpath} with socket {socket_path}")
-    else:
-        socket_path, proc = create_nbd_socket(diskpath, read_only=False, transfer_id=transfer_id)
-        nbd_processes[diskpath] = proc
-        logger.debug(f"Started writable NBD server for image {diskpath} with socket {socket_path}")
-
-    # Connect and write data via NBD
-    conn = nbd.NBD()
-    try:
-        conn.connect_unix(socket_path)
+async def zero_via_nbd(diskpath: str, transfer_id: str, offset: int, size: int, flush: bool = False):
+    """
+    Zero a range of the qcow2 file at diskpath via its writable NBD server.
+    """
+    pool = await writable_pool(diskpath, transfer_id)
+    await zero_nbd(pool, transfer_id, offset, size, flush)
 
-        offset = start
-        async for chunk in request.stream():
-            if not chunk:
-                continue
-            conn.pwrite(chunk, offset)
-            offset += len(chunk)
+async def flush_via_nbd(diskpath: str, transfer_id: str):
+    """
+    Flush the writes of an upload, if its NBD server is running.
+    """
+    if not running_server(diskpath, read_only=False):
+        return
+    pool = await writable_pool(diskpath, transfer_id)
+    await flush_nbd(pool, transfer_id)
 
-        conn.flush()
-        logger.debug(f"Wrote {offset - start} bytes to {diskpath} starting at offset {start}")
-    finally:
-        conn.close()
+async def writable_pool(diskpath: str, transfer_id: str):
+    socket_path = await asyncio.to_thread(ensure_server, diskpath, None, False)
+    return get_pool(transfer_id, socket_path, image=diskpath, size=MAX_WRITERS)
 
 # =============================
 # Internal API endpoint: Check backup job status
 # =============================
 
 @backup_router.get("/internal/backup/{vm}/status", response_model=BackupStatusResponse)
-def get_backup_status(vm: str, request: Request):
+async def get_backup_status(vm: str, request: Request):
     """
     Internal API endpoint to check the status of backup job for a VM.
-    Uses virsh domjobinfo command to determine if backup is in progress.
+    Reads the backup job table kept up to date by libvirt job events.
     Returns backup status information.
     """
     # Check internal authentication
@@ -710,7 +602,8 @@ def get_backup_status(vm: str, request: Request):
     return BackupStatusResponse(
         vm_name=vm,
         backup_in_progress=status_info["backup_in_progress"],
-        job_info=status_info["job_info"]
+        job_info=status_info["job_info"],
+        job_state=status_info["job_state"]
     )
 
 # =============================
@@ -718,195 +611,114 @@ def get_backup_status(vm: str, request: Request):
 # =============================
 
 
-def get_extents_via_nbd(image, bitmap_name = None, socket_path=None, disk_label=None, context="dirty", transfer_id: str = None):
+def block_status_via_nbd(image, bitmap_name = None, socket_path=None, disk_label=None, transfer_id: str = None):
     """
-    Generate image extents for Veeam from raw or qcow2 image.
+    Read the block status of a raw or qcow2 image for Veeam.
 
     :param image: path to qcow2/raw image
-    :param context: "zero" for full backup, "dirty" for incremental
-    :return: list of extents dictionaries
+    :param bitmap_name: dirty bitmap for incremental backup, None for allocation
+    :return: generator of (lengths, flags) arrays, one per block status request
     """
 
-    extents = []
+    if bitmap_name is None:
+        meta_context = nbd.CONTEXT_BASE_ALLOCATION    # only metadata for allocation
+    else:
+        # Tell NBD which bitmap to use
+        meta_context = f"{nbd.CONTEXT_QEMU_DIRTY_BITMAP}{bitmap_name}"
 
     if socket_path:
-        # NBD server is already running via "virsh backup-begin"
+        # NBD server is already running via the libvirt backup job
         logger.debug(f"Using existing NBD server for image {image} with socket {socket_path}")
-        proc = None
+        server = nullcontext(socket_path)
     else:
-        logger.debug(f"Starting NBD server for image {image} for transfer_id {transfer_id}")
-        socket_path, proc = create_nbd_socket(image, bitmap_name, transfer_id=transfer_id)
-        logger.debug(f"Started NBD server for image {image} with socket {socket_path} and proc {proc}")
-
-    conn = nbd.NBD()
-    try:
-        if bitmap_name:
-            # Tell NBD which bitmap to use
-            conn.add_meta_context(f"{nbd.CONTEXT_QEMU_DIRTY_BITMAP}{bitmap_name}")
-        else:
-            conn.add_meta_context(nbd.CONTEXT_BASE_ALLOCATION)    # only metadata for allocation
-
-        if disk_label:
-            conn.set_export_name(disk_label)
-
-        conn.connect_unix(socket_path)
-
-        count = conn.get_nr_meta_contexts()
-        for i in range(count):
-            logger.debug(f"Connected to NBD socket: {socket_path} with meta context: {conn.get_meta_context(i)}")
-
-        img_size = conn.get_size()  # virtual size
-
-        if context == "zero" or bitmap_name is None:
-            def callback(metacontext, offset, entries, handle):
-                pos = offset
-                for i in range(0, len(entries), 2):
-                    length = entries[i]
-                    flags = entries[i+1]
-                    zero = bool(flags & nbd.STATE_ZERO)
-                    hole = bool(flags & nbd.STATE_HOLE)
-                    extents.append({
-                        "start": pos,
-                        "length": length,
-                        "zero": zero,
-                        "hole": hole,
-                    })
-                    pos += length
-
-            conn.block_status(
-                img_size,
-                0,
-                callback
-            )
+        # Kept running for the downloads that follow
+        server = use_server(image, bitmap_name)
 
-        elif context == "dirty":
-            def callback(metacontext, offset, entries, handle):
-                pos = offset
-                for i in range(0, len(entries), 2):
-                    length = entries[i]
-                    flags = entries[i+1]
-                    dirty = bool(flags & nbd.STATE_DIRTY)
-                    zero = bool(flags & nbd.STATE_ZERO)
-                    extents.append({
-                        "start": pos,
-                        "length": length,
-                        "dirty": dirty,
-                        "zero": zero,
-                    })
-                    pos += length
-
-            conn.block_status(
-                img_size,
-                0,
-                callback
-            )
-    finally:
-        conn.close()  # must close explicitly
-        if proc:
-            proc.terminate()
-            proc.wait()
-
-    logger.info(f"Extents of {image} before merging: {extents}")
-
-    # Merge adjacent extents with same flags to reduce number of extents
-    merged = []
-    for e in extents:
-        if not merged:
-            merged.append(e)
-            continue
-        last = merged[-1]
-        if context == "zero" or bitmap_name is None:
-            if e["zero"] == last["zero"] and e.get("hole", False) == last.get("hole", False) and last["start"] + last["length"] == e["start"]:
-                last["length"] += e["length"]
-            else:
-                merged.append(e)
-        else:
-            if e["dirty"] == last["dirty"] and e["zero"] == last["zero"] and last["start"] + last["length"] == e["start"]:
-                last["length"] += e["length"]
-            else:
-                merged.append(e)
+    entries_count = 0
+    with server as socket_path:
+        conn = nbd.NBD()
+        try:
+            conn.add_meta_context(meta_context)
 
-    logger.info(f"Extents of {image}: {merged}")
+            if disk_label:
+                conn.set_export_name(disk_label)
 
-    return merged
+            conn.connect_unix(socket_path)
 
-# =============================
-# Internal method: Create NBD socket and wait for connection
-# =============================
+            count = conn.get_nr_meta_contexts()
+            for i in range(count):
+                logger.debug(f"Connected to NBD socket: {socket_path} with meta context: {conn.get_meta_context(i)}")
+
+            img_size = conn.get_size()  # virtual size
+
+            covered = 0
+
+            while covered < img_size:
+                # Raw block status entries of this request
+                lengths = array("Q")
+                flags = array("I")
+
+                def callback(metacontext, offset, entries, err):
+                    nonlocal covered
+                    if metacontext != meta_context:
+                        return 0
+                    lengths.extend(entries[0::2])
+                    flags.extend(entries[1::2])
+                    covered = offset + sum(entries[0::2])
+                    return 0
+
+                # The server may describe less than requested, ask again until the
+                # whole image is covered
+                before = covered
+                conn.block_status(min(img_size - covered, BLOCK_STATUS_MAX), covered, callback)
+                if covered <= before:
+                    raise RuntimeError(f"No block status progress for {image} at offset {covered}")
+                entries_count += len(lengths)
+                yield lengths, flags
+        finally:
+            conn.close()  # must close explicitly
 
-def get_socket_path(image, transfer_id: str = None):
-    if transfer_id:
-        socket_path = f"/tmp/nbd-{os.path.basename(image)}--{transfer_id}.sock"
-    else:
-        socket_path = f"/tmp/nbd-{os.path.basename(image)}--{uuid.uuid4().hex}.sock"
-    return socket_path
-
-def create_nbd_socket(image, bitmap_name=None, read_only=True, transfer_id=None):
-    socket_path = get_socket_path(image, transfer_id)
-    if os.path.exists(socket_path):
-        os.remove(socket_path)
-    cmd = ["qemu-nbd", "-f", "qcow2"]
-    if read_only:
-        cmd.append("--read-only")
-    cmd.extend(["--persistent", f"--socket={socket_path}", "--shared", "100"])
-    if bitmap_name:
-        cmd.append(f"--bitmap={bitmap_name}")
-    cmd.append(image)
-    logger.debug(f"Starting NBD server: {cmd}")
-    proc = subprocess.Popen(cmd)
-    wait_for_socket(socket_path)
-    return socket_path, proc
-
-def wait_for_socket(path, timeout=5.0):
-    deadline = time.time() + timeout
-    while time.time() < deadline:
-        if os.path.exists(path):
-            return
-        time.sleep(0.05)
-    raise RuntimeError(f"NBD socket not accepting connections: {path}")
-
-# =============================
-# Internal method: Get virtual size of qcow2 file
-# =============================
-def get_virtual_size(file_path):
-    output = subprocess.check_output(["qemu-img", "info", "-U", file_path])
-    output = output.decode("utf-8")
-    lines = output.split("\n")
-    for line in lines:
-        if line.startswith("virtual size"):
-            size = line.split()[4].split("(")[1]
-            return int(size)
-    raise ValueError(f"Could not find virtual size for {file_path}")
+    logger.info(f"Read {entries_count} block status entries of {image} with meta context {meta_context}")
 
 # =============================
 # Internal method: Shutdown NBD server for a disk
 # =============================
 
 def shutdown_nbd_server(diskpath):
-    proc = nbd_processes.get(diskpath)
-    if proc:
-        logger.debug(f"Terminating NBD server for image {diskpath} with proc {proc}")
-        proc.terminate()
-        proc.wait()
-        del nbd_processes[diskpath]
+    close_image_pools(diskpath)
+    drop_image_extents(diskpath)
+    stop_image_servers(diskpath)
 
 # =============================
 # Internal method: Finalize backup - merge backup into VM
 # =============================
 
-def finalize_backup_vm(vm, volumes):
+async def add_bitmaps(volume_paths, checkpoint_name):
+    """
+    Create the bitmap of a new checkpoint on every disk of a stopped VM.
+    Fails the backup listing every disk it could not be created on.
     """
-    Finalize backup by merging the backup file into the original VM disk
-    using virsh blockcommit command.
+    errors = await run_bitmaps("add", volume_paths, checkpoint_name)
+    if errors:
+        failed = "; ".join(f"{path}: {error}" for path, error in errors.items())
+        raise HTTPException(status_code=500, detail=f"Cannot create bitmap {checkpoint_name} on {len(errors)} of {len(volume_paths)} disks: {failed}")
+
+async def finalize_backup_vm(vm, volumes):
+    """
+    Finalize backup by ending the backup job of a running VM or stopping the
+    NBD servers of a stopped one, then removing the previous checkpoint.
     """
     # Load metadata to get disk information
     meta = load_meta(vm)
     previous_checkpoint = meta["previous_checkpoint"]
 
-    dom, state = get_vm(vm)
+    dom, state = await asyncio.to_thread(get_vm, vm)
     if state == "running":
+        for disk in meta["disks"].values():
+            close_image_pools(disk.get("file_path"))
+            drop_image_extents(disk.get("file_path"))
         try:
-            subprocess.run(["virsh", "domjobabort", vm], check=True)
+            await asyncio.to_thread(abort_job, dom)
             logger.debug(f"Aborted backup job and stopped NBD server for {vm}")
         except Exception as e:
             logger.error(f"Error aborting backup job for {vm}: {e}")
@@ -915,37 +727,28 @@ def finalize_backup_vm(vm, volumes):
         for volume in volumes:
             # stop NBD process
             volume_path = f"/mnt/{volume['storageid']}/{volume['path']}"
-            shutdown_nbd_server(volume_path)
+            await asyncio.to_thread(shutdown_nbd_server, volume_path)
 
-    # remove previous checkpint by virsh checkpoint-delete
+    # remove previous checkpoint
     if previous_checkpoint:
 
         if state == "running":
             try:
-                subprocess.run(["virsh", "checkpoint-delete", vm, previous_checkpoint], check=True)
-                logger.debug(f"Deleted previous checkpoint {previous_checkpoint} for {vm}")                
+                await asyncio.to_thread(delete_checkpoint, dom, previous_checkpoint)
+                logger.debug(f"Deleted previous checkpoint {previous_checkpoint} for {vm}")
             except Exception as e:
                 logger.error(f"Error deleting previous checkpoint: {e}")
         elif meta["previous_checkpoint"] and volumes:
-            for volume in volumes:
-                try:
-                    volume_path = f"/mnt/{volume['storageid']}/{volume['path']}"
-                    # remove last bitmap or checkpoint if exists
-                    cmd = [
-                        "qemu-img", "bitmap",
-                        "--remove",
-                        volume_path,
-                        meta["previous_checkpoint"]
-                    ]
-                    subprocess.run(cmd, check=True)
-                    logger.info(f"Removed previous bitmap {meta["previous_checkpoint"]} from {volume_path}")
-                except Exception as e:
-                    logger.error(f"Error removing previous bitmap {meta["previous_checkpoint"]} from {volume_path}: {e}")
+            # remove last bitmap or checkpoint if exists, on all disks at once
+            volume_paths = [f"/mnt/{volume['storageid']}/{volume['path']}" for volume in volumes]
+            errors = await run_bitmaps("remove", volume_paths, previous_checkpoint)
+            removed = [p for p in volume_paths if p not in errors]
+            logger.info(f"Removed previous bitmap {previous_checkpoint} from {removed}")
 
 
         meta["previous_mode"] = None
         meta["previous_checkpoint"] = None
-        save_meta(vm, meta)
+        await asyncio.to_thread(save_meta, vm, meta)
 
 # ---- Finalize backup ----
 
@@ -961,7 +764,8 @@ async def finalize_backup(vm: str, request: Request):
 
     volumes = payload["volumes"]
 
-    return finalize_backup_vm(vm, volumes)
+    async with meta_lock(vm), backup_slots.slot_async(vm):
+        return await finalize_backup_vm(vm, volumes)
 
 # =============================
 # Internal method: Create checkpoint xml from bitmap
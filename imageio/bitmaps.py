@@ -0,0 +1,43 @@
+import asyncio
+from contextlib import nullcontext
+
+from imageio.config import NBD
+from imageio.logging_imageio import logger
+
+# =============================
+# Config
+# =============================
+
+# qemu-img bitmap processes run at once, over all backups of the host, 0 means unlimited
+BITMAP_JOBS = NBD.getint("bitmap_jobs", fallback=4)
+
+_bitmap_slots = asyncio.Semaphore(BITMAP_JOBS) if BITMAP_JOBS > 0 else nullcontext()
+
+# =============================
+# Bitmaps of stopped VM images
+# =============================
+
+async def run_bitmap(op: str, path: str, name: str):
+    """
+    Add or remove a persistent bitmap of an image with qemu-img bitmap.
+    """
+    cmd = ["qemu-img", "bitmap", f"--{op}", path, name]
+    async with _bitmap_slots:
+        logger.debug(f"Running {cmd}")
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        _, err = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"qemu-img bitmap --{op} failed with code {proc.returncode}: {err.decode().strip()}")
+
+async def run_bitmaps(op: str, paths: list, name: str) -> dict:
+    """
+    Run the same bitmap operation on every image concurrently.
+    Returns the error of each image it failed on, keyed by path.
+    """
+    results = await asyncio.gather(*(run_bitmap(op, path, name) for path in paths), return_exceptions=True)
+    errors = {}
+    for path, result in zip(paths, results):
+        if isinstance(result, Exception):
+            errors[path] = str(result)
+            logger.error(f"Error running bitmap --{op} {name} on {path}: {result}")
+    return errors
@@ -10,3 +10,16 @@ PROXY = config["proxy"]
 SSL = config["ssl"]
 LOGGING = config["logging"]
 
+
+# Optional sections
+if not config.has_section("nbd"):
+    config.add_section("nbd")
+NBD = config["nbd"]
+
+if not config.has_section("meta"):
+    config.add_section("meta")
+META = config["meta"]
+
+if not config.has_section("throttle"):
+    config.add_section("throttle")
+THROTTLE = config["throttle"]
@@ -0,0 +1,253 @@
+from array import array
+from bisect import bisect_right
+
+from imageio.config import NBD
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# =============================
+# Config
+# =============================
+
+# Zero extents shorter than this are read like data, so that fragmented
+# images do not turn into many tiny NBD reads
+MIN_ZERO_EXTENT = NBD.getint("min_zero_extent", fallback=1024 * 1024)
+
+# Zero extents are sent in slices of a single shared buffer of this size
+ZERO_CHUNK_SIZE = NBD.getint("chunk_size", fallback=2 * 1024 * 1024)
+ZERO_BUFFER = memoryview(bytes(ZERO_CHUNK_SIZE))
+
+# Extent flags
+FLAG_ZERO = 1
+FLAG_HOLE = 2
+FLAG_DIRTY = 4
+
+# NBD block status flags (nbd.STATE_HOLE, nbd.STATE_ZERO, nbd.STATE_DIRTY)
+NBD_STATE_HOLE = 1
+NBD_STATE_ZERO = 2
+NBD_STATE_DIRTY = 1
+
+# (transfer id, context) -> ExtentMap
+extent_maps = {}
+
+# =============================
+# Extent map
+# =============================
+
+class ExtentMap:
+    """
+    Merged extents of an image as parallel start/length/flags arrays.
+
+    context is "zero" (zero and hole flags) or "dirty" (dirty and zero flags),
+    and decides which keys the extents have when returned to the client.
+    """
+
+    def __init__(self, context: str, image: str = None):
+        self.context = context
+        self.image = image
+        self.starts = array("Q")
+        self.lengths = array("Q")
+        self.flags = array("B")
+
+    @classmethod
+    def from_block_status(cls, start: int, lengths: array, nbd_flags: array, context: str, image: str = None):
+        """
+        Build a merged map from raw block status entries covering the image from
+        start: consecutive entries with the same flags become one extent.
+        """
+        m = cls(context, image)
+        m.extend(lengths, nbd_flags, start)
+        return m
+
+    def extend(self, lengths: array, nbd_flags: array, start: int = None):
+        """
+        Merge the next raw block status entries into the map. They continue at
+        the end of the map unless start is given; the last extent of the map
+        grows when the first new entries have the same flags.
+        """
+        if not lengths:
+            return
+        if start is None:
+            start = self.starts[-1] + self.lengths[-1] if self.starts else 0
+
+        if numpy is not None:
+            l = numpy.frombuffer(lengths, dtype=numpy.uint64)
+            f = numpy.frombuffer(nbd_flags, dtype=numpy.uint32)
+            if self.context == "dirty":
+                flags = numpy.where(f & NBD_STATE_DIRTY, FLAG_DIRTY, 0) | numpy.where(f & NBD_STATE_ZERO, FLAG_ZERO, 0)
+            else:
+                flags = numpy.where(f & NBD_STATE_ZERO, FLAG_ZERO, 0) | numpy.where(f & NBD_STATE_HOLE, FLAG_HOLE, 0)
+            flags = flags.astype(numpy.uint8)
+
+            # Run-length encode: an extent starts wherever the flags change
+            ends = numpy.cumsum(l, dtype=numpy.uint64) + numpy.uint64(start)
+            first = numpy.concatenate(([0], numpy.flatnonzero(flags[1:] != flags[:-1]) + 1))
+            last = numpy.concatenate((first[1:] - 1, [len(l) - 1]))
+            run_ends = ends[last]
+            run_starts = numpy.concatenate(([numpy.uint64(start)], run_ends[:-1]))
+            run_lengths = run_ends - run_starts
+            run_flags = flags[first]
+
+            if self.flags and self.flags[-1] == run_flags[0]:
+                self.lengths[-1] += int(run_lengths[0])
+                run_starts, run_lengths, run_flags = run_starts[1:], run_lengths[1:], run_flags[1:]
+            self.starts.frombytes(run_starts.astype(numpy.uint64).tobytes())
+            self.lengths.frombytes(run_lengths.tobytes())
+            self.flags.frombytes(run_flags.tobytes())
+            return
+
+        if self.context == "dirty":
+            translate = lambda f: (FLAG_DIRTY if f & NBD_STATE_DIRTY else 0) | (FLAG_ZERO if f & NBD_STATE_ZERO else 0)
+        else:
+            translate = lambda f: (FLAG_ZERO if f & NBD_STATE_ZERO else 0) | (FLAG_HOLE if f & NBD_STATE_HOLE else 0)
+        pos = start
+        for length, f in zip(lengths, nbd_flags):
+            flags = translate(f)
+            if self.flags and self.flags[-1] == flags:
+                self.lengths[-1] += length
+            else:
+                self.starts.append(pos)
+                self.lengths.append(length)
+                self.flags.append(flags)
+            pos += length
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _dict(self, start: int, length: int, flags: int) -> dict:
+        if self.context == "dirty":
+            return {"start": start, "length": length, "dirty": bool(flags & FLAG_DIRTY), "zero": bool(flags & FLAG_ZERO)}
+        return {"start": start, "length": length, "zero": bool(flags & FLAG_ZERO), "hole": bool(flags & FLAG_HOLE)}
+
+    def query(self, start: int, length: int):
+        """
+        Yield (start, length, flags) of the extents overlapping [start, start + length),
+        clipped to the range.
+        """
+        end = start + length
+        i = max(bisect_right(self.starts, start) - 1, 0)
+        while i < len(self.starts) and self.starts[i] < end:
+            e_start = max(self.starts[i], start)
+            e_end = min(self.starts[i] + self.lengths[i], end)
+            if e_end > e_start:
+                yield e_start, e_end - e_start, self.flags[i]
+            i += 1
+
+    def json_items(self, first: int = 0, last: int = None) -> str:
+        """
+        The extents first..last as comma separated JSON objects, without building the dicts.
+        """
+        # The flag keys of each possible flags value, rendered once
+        if self.context == "dirty":
+            keys = lambda f: f'"dirty":{str(bool(f & FLAG_DIRTY)).lower()},"zero":{str(bool(f & FLAG_ZERO)).lower()}'
+        else:
+            keys = lambda f: f'"zero":{str(bool(f & FLAG_ZERO)).lower()},"hole":{str(bool(f & FLAG_HOLE)).lower()}'
+        suffix = [keys(f) for f in range(8)]
+        return ",".join(
+            f'{{"start":{s},"length":{l},{suffix[f]}}}'
+            for s, l, f in zip(self.starts[first:last], self.lengths[first:last], self.flags[first:last])
+        )
+
+    def to_json(self) -> str:
+        """
+        The extents as a compact JSON array.
+        """
+        return "[" + self.json_items() + "]"
+
+    def to_dicts(self, start: int = None, length: int = None) -> list:
+        """
+        The extents as returned to the client, optionally limited to a range.
+        """
+        if start is None:
+            return [self._dict(s, l, f) for s, l, f in zip(self.starts, self.lengths, self.flags)]
+        return [self._dict(s, l, f) for s, l, f in self.query(start, length)]
+
+# =============================
+# Extent maps per transfer
+# =============================
+
+def store_extents(transfer_id: str, m: ExtentMap) -> ExtentMap:
+    """
+    Remember the extent map of a transfer for its context.
+    """
+    extent_maps[(transfer_id, m.context)] = m
+    return m
+
+def get_extent_map(transfer_id: str, context: str):
+    return extent_maps.get((transfer_id, context))
+
+def drop_image_extents(image: str):
+    """
+    Forget the extent maps of all transfers of an image.
+    """
+    for key in [key for key, m in extent_maps.items() if m.image == image]:
+        del extent_maps[key]
+
+def segments(transfer_id: str, start: int, length: int):
+    """
+    Split [start, start + length) into (offset, length, zero) segments using
+    the allocation map of the transfer. Without a map, the whole range is one
+    data segment.
+    """
+    end = start + length
+    m = extent_maps.get((transfer_id, "zero"))
+    if not m:
+        return [(start, length, False)]
+
+    result = []
+    pos = start
+    for e_start, e_length, flags in m.query(start, length):
+        zero = bool(flags & FLAG_ZERO) and e_length >= MIN_ZERO_EXTENT
+        if result and result[-1][2] == zero:
+            offset, seg_length, _ = result[-1]
+            result[-1] = (offset, seg_length + e_length, zero)
+        else:
+            result.append((e_start, e_length, zero))
+        pos = e_start + e_length
+
+    if pos < end:
+        # Past the end of the map, read whatever is there
+        if result and not result[-1][2]:
+            offset, seg_length, _ = result[-1]
+            result[-1] = (offset, end - offset, False)
+        else:
+            result.append((pos, end - pos, False))
+    return result
+
+def stream_json(m: ExtentMap, batches=(), transfer_id: str = None, batch_extents: int = 65536):
+    """
+    Yield the extents of m as a compact JSON array in pieces, first those already
+    in the map, then those of the (lengths, flags) block status batches as they
+    are merged. An extent is only sent once the next batch cannot grow it any
+    more. With transfer_id, the complete map is stored for later calls.
+    """
+    yield b"["
+    sent = 0
+
+    def pending(done: int):
+        nonlocal sent
+        while sent < done:
+            last = min(done, sent + batch_extents)
+            yield (b"," if sent else b"") + m.json_items(sent, last).encode()
+            sent = last
+
+    for lengths, flags in batches:
+        m.extend(lengths, flags)
+        yield from pending(len(m) - 1)
+    yield from pending(len(m))
+    yield b"]"
+
+    if transfer_id:
+        store_extents(transfer_id, m)
+
+def zero_chunks(length: int):
+    """
+    Yield length zero bytes as slices of the shared zero buffer.
+    """
+    while length > 0:
+        n = min(length, ZERO_CHUNK_SIZE)
+        yield ZERO_BUFFER[:n]
+        length -= n
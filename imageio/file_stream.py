@@ -0,0 +1,71 @@
+import os
+
+from fastapi import HTTPException, Request
+
+from imageio.logging_imageio import logger
+from imageio.nbd_stream import READ_CHUNK_SIZE
+from imageio.scheduler import limit_stream
+from imageio.utils import range_response
+
+# =============================
+# Direct file reader
+# =============================
+
+def _free_buffer(buffers: list, size: int) -> bytearray:
+    """
+    A buffer of the list no longer referenced by a chunk, or a new one. The
+    transport may keep views of sent chunks until they are on the wire, and
+    a bytearray cannot be resized while views of it exist.
+    """
+    for buf in buffers:
+        try:
+            buf.append(0)
+        except BufferError:
+            continue
+        del buf[-1]
+        return buf
+    buf = bytearray(size)
+    buffers.append(buf)
+    return buf
+
+def file_read_range(path: str, start: int, length: int, chunk_size: int = READ_CHUNK_SIZE):
+    """
+    Yield the bytes of [start, start + length) of a file as memoryviews of
+    buffers reused once the transport is done with them. I/O errors and
+    files shorter than the range end the stream with an error.
+    """
+    if length <= 0:
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, start, length, os.POSIX_FADV_SEQUENTIAL)
+        buffers = []
+        pos = start
+        end = start + length
+        while pos < end:
+            n = min(chunk_size, end - pos)
+            view = memoryview(_free_buffer(buffers, chunk_size))[:n]
+            got = 0
+            while got < n:
+                r = os.preadv(fd, [view[got:]], pos + got)
+                if r == 0:
+                    raise RuntimeError(f"{path} ended at offset {pos + got}, before {end}")
+                got += r
+            yield view
+            pos += n
+    finally:
+        os.close(fd)
+
+def download_file(diskpath: str, request: Request, transfer_id: str):
+    """
+    Serve the bytes of a file as they are, for raw volumes and cow downloads
+    of images that are not part of a backup.
+    """
+    try:
+        file_size = os.stat(diskpath).st_size
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Disk image for {diskpath} not found")
+
+    logger.debug(f"Serving {diskpath} directly from the file")
+    return range_response(request, file_size, lambda start, length: limit_stream(transfer_id, file_read_range(diskpath, start, length), diskpath))
@@ -0,0 +1,52 @@
+import json
+import os
+import subprocess
+import threading
+
+from imageio.logging_imageio import logger
+
+# =============================
+# Image metadata cache
+# =============================
+
+# Images whose metadata is kept
+MAX_CACHED_IMAGES = 256
+
+# path -> ((mtime, size), info)
+image_infos = {}
+_lock = threading.Lock()
+
+def _read_info(path: str) -> dict:
+    output = subprocess.check_output(["qemu-img", "info", "-U", "--output=json", path])
+    data = json.loads(output)
+    specific = data.get("format-specific", {}).get("data", {})
+    return {
+        "virtual_size": data["virtual-size"],
+        "format": data.get("format"),
+        "cluster_size": data.get("cluster-size"),
+        "bitmaps": [b.get("name") for b in specific.get("bitmaps", [])],
+    }
+
+def image_info(path: str) -> dict:
+    """
+    Virtual size, format, cluster size and bitmap names of an image, from
+    qemu-img info. Cached until the file is modified.
+    """
+    st = os.stat(path)
+    version = (st.st_mtime_ns, st.st_size)
+    with _lock:
+        cached = image_infos.get(path)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    info = _read_info(path)
+    logger.debug(f"Image info of {path}: {info}")
+    with _lock:
+        if path not in image_infos and len(image_infos) >= MAX_CACHED_IMAGES:
+            # Forget the image cached first
+            del image_infos[next(iter(image_infos))]
+        image_infos[path] = (version, info)
+    return info
+
+def get_virtual_size(file_path):
+    return image_info(file_path)["virtual_size"]
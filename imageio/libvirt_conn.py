@@ -0,0 +1,205 @@
+import threading
+import time
+
+import libvirt
+
+from imageio.logging_imageio import logger
+
+# Shared connection to the local libvirtd, opened on first use
+_conn = None
+_conn_lock = threading.Lock()
+_event_thread = None
+_events_lock = threading.Lock()
+
+# vm -> {"state", "started", "finished", "disks", "stats"}, kept up to date by libvirt events
+backup_jobs = {}
+_jobs_lock = threading.Lock()
+
+# Names of the block job states in block job events
+BLOCK_JOB_STATES = {
+    libvirt.VIR_DOMAIN_BLOCK_JOB_COMPLETED: "completed",
+    libvirt.VIR_DOMAIN_BLOCK_JOB_FAILED: "failed",
+    libvirt.VIR_DOMAIN_BLOCK_JOB_CANCELED: "cancelled",
+    libvirt.VIR_DOMAIN_BLOCK_JOB_READY: "ready",
+}
+
+# =============================
+# Connection
+# =============================
+
+def _run_events():
+    while True:
+        try:
+            libvirt.virEventRunDefaultImpl()
+        except Exception as e:
+            logger.error(f"Error running libvirt events: {e}")
+            time.sleep(1)
+
+def _start_events():
+    # The event implementation must be registered before a connection is opened
+    global _event_thread
+    with _events_lock:
+        if _event_thread is None:
+            libvirt.virEventRegisterDefaultImpl()
+            _event_thread = threading.Thread(target=_run_events, name="libvirt-events", daemon=True)
+            _event_thread.start()
+
+def _open():
+    conn = libvirt.open(None)
+    # Detect a dead libvirtd without waiting for the next call to fail
+    conn.setKeepAlive(5, 3)
+    conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_JOB_COMPLETED, _on_job_completed, None)
+    conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2, _on_block_job, None)
+    _reconcile_jobs(conn)
+    return conn
+
+def get_connection():
+    """
+    Return the long-lived libvirt connection, reconnecting when it was lost.
+    libvirt connections are thread safe, so callers share it.
+    """
+    global _conn
+    _start_events()
+    with _conn_lock:
+        if _conn is not None:
+            try:
+                if _conn.isAlive():
+                    return _conn
+            except libvirt.libvirtError:
+                pass
+            logger.warning("libvirt connection lost, reconnecting")
+            try:
+                _conn.close()
+            except libvirt.libvirtError:
+                pass
+        _conn = _open()
+        return _conn
+
+def lookup_domain(vm: str):
+    """
+    Return the domain of a VM, or None when libvirt does not know it.
+    Other errors, e.g. libvirtd being unreachable, are raised.
+    """
+    conn = get_connection()
+    try:
+        return conn.lookupByName(vm)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+            return None
+        logger.error(f"Error looking up VM {vm}: {e}")
+        raise
+
+# =============================
+# Backup jobs and checkpoints
+# =============================
+
+def backup_begin(dom, backup_xml: str, checkpoint_xml: str = None):
+    """
+    Start a pull mode backup job, creating the checkpoint at the same time.
+    """
+    dom.backupBegin(backup_xml, checkpoint_xml, 0)
+
+def has_checkpoint(dom, name: str) -> bool:
+    return name in (c.getName() for c in dom.listAllCheckpoints())
+
+def redefine_checkpoint(dom, checkpoint_xml: str):
+    """
+    Make libvirt know a checkpoint whose bitmaps already exist in the images.
+    """
+    dom.checkpointCreateXML(checkpoint_xml, libvirt.VIR_DOMAIN_CHECKPOINT_CREATE_REDEFINE)
+
+def delete_checkpoint(dom, name: str):
+    dom.checkpointLookupByName(name).delete()
+
+def abort_job(dom):
+    dom.abortJob()
+
+def job_stats(dom) -> dict:
+    """
+    Statistics of the active job of a domain, empty when there is none.
+    """
+    stats = dom.jobStats()
+    if stats.get("type", libvirt.VIR_DOMAIN_JOB_NONE) == libvirt.VIR_DOMAIN_JOB_NONE:
+        return {}
+    return stats
+
+def completed_job_stats(dom) -> dict:
+    """
+    Statistics of the last job of a domain that ended, empty when unknown.
+    """
+    try:
+        return dom.jobStats(libvirt.VIR_DOMAIN_JOB_STATS_COMPLETED)
+    except libvirt.libvirtError as e:
+        logger.debug(f"No completed job statistics for {dom.name()}: {e}")
+        return {}
+
+# =============================
+# Backup job table
+# =============================
+
+def job_started(vm: str):
+    """
+    Record a backup job that libvirt has just accepted for the VM.
+    """
+    with _jobs_lock:
+        backup_jobs[vm] = {"state": "running", "started": time.time(), "finished": None, "disks": {}, "stats": {}}
+
+def get_job(vm: str) -> dict:
+    """
+    Last known state of the backup job of a VM, None when none was started.
+    """
+    with _jobs_lock:
+        job = backup_jobs.get(vm)
+        return dict(job, disks=dict(job["disks"])) if job else None
+
+def _finish_job(vm: str, state: str, stats: dict = None):
+    with _jobs_lock:
+        job = backup_jobs.get(vm)
+        if job is None or job["state"] != "running":
+            return
+        job["state"] = state
+        job["finished"] = time.time()
+        if stats:
+            job["stats"] = stats
+    logger.info(f"Backup job of {vm} {state}")
+
+def _job_outcome(stats: dict) -> str:
+    # The type of completed job statistics tells failed and cancelled jobs apart
+    job_type = stats.get("type")
+    if job_type == libvirt.VIR_DOMAIN_JOB_CANCELLED:
+        return "cancelled"
+    if job_type == libvirt.VIR_DOMAIN_JOB_FAILED or stats.get("errmsg"):
+        return "failed"
+    return "completed"
+
+def _on_job_completed(conn, dom, params, opaque):
+    # Emitted when a job ends; params have its statistics but not how it ended
+    if params.get("operation") != libvirt.VIR_DOMAIN_JOB_OPERATION_BACKUP:
+        return
+    stats = completed_job_stats(dom) or params
+    _finish_job(dom.name(), _job_outcome(stats), stats)
+
+def _on_block_job(conn, dom, disk, job_type, status, opaque):
+    if job_type != libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_BACKUP:
+        return
+    vm = dom.name()
+    state = BLOCK_JOB_STATES.get(status, str(status))
+    with _jobs_lock:
+        job = backup_jobs.get(vm)
+        if job is not None:
+            job["disks"][disk] = state
+    logger.debug(f"Backup block job of {vm} disk {disk} {state}")
+
+def _reconcile_jobs(conn):
+    # Events may have been missed while disconnected; ask for the jobs still thought running
+    with _jobs_lock:
+        running = [vm for vm, job in backup_jobs.items() if job["state"] == "running"]
+    for vm in running:
+        try:
+            dom = conn.lookupByName(vm)
+            if job_stats(dom):
+                continue
+            stats = completed_job_stats(dom)
+        except libvirt.libvirtError:
+            stats = {}
+        _finish_job(vm, _job_outcome(stats), stats)
@@ -0,0 +1,207 @@
+import asyncio
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager
+
+from imageio.config import META
+from imageio.logging_imageio import logger
+
+# =============================
+# Config
+# =============================
+
+META_ROOT = "/backup/meta"
+
+# "json" keeps one file per VM, "sqlite" one database for all VMs of the host
+META_BACKEND = META.get("backend", fallback="json")
+META_DATABASE = META.get("database", fallback=os.path.join(META_ROOT, "meta.db"))
+
+# Seconds the writer waits for more saves before syncing them together,
+# saves arriving while a batch is written always go together in the next one
+META_FLUSH_DELAY = META.getfloat("flush_delay", fallback=0)
+
+# vm -> [asyncio.Lock, callers holding or waiting for it], dropped when unused
+meta_locks = {}
+
+# =============================
+# Backends
+# =============================
+
+class JsonBackend:
+    """
+    One JSON file per VM. Several saves of a VM within a batch are written
+    once, and the directory is synced once per batch.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, vm: str) -> str:
+        return os.path.join(self.root, f"{vm}.json")
+
+    def read(self, vm: str):
+        try:
+            with open(self.path(vm)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def write_many(self, batch: dict):
+        os.makedirs(self.root, exist_ok=True)
+        for vm, meta in batch.items():
+            tmp = self.path(vm) + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(meta, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path(vm))
+        fd = os.open(self.root, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+class SqliteBackend:
+    """
+    A single database for all VMs, a batch is one transaction and one sync.
+    VMs not in the database yet are read from their JSON file.
+    """
+
+    def __init__(self, path: str, json_root: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (vm TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.json = JsonBackend(json_root)
+        self.lock = threading.Lock()
+
+    def read(self, vm: str):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM meta WHERE vm = ?", (vm,)).fetchone()
+        if row:
+            return json.loads(row[0])
+        return self.json.read(vm)
+
+    def write_many(self, batch: dict):
+        rows = [(vm, json.dumps(meta)) for vm, meta in batch.items()]
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany("INSERT OR REPLACE INTO meta (vm, data) VALUES (?, ?)", rows)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+# =============================
+# Metadata store
+# =============================
+
+class MetaStore:
+    """
+    In-memory cache of the backup metadata of every VM in front of a backend.
+    Saves are queued and written by one thread in batches; a save can wait
+    until its batch is on disk.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.cache = {}
+        self.dirty = {}
+        self.waiters = []
+        self.cond = threading.Condition()
+        self.writer = None
+
+    def load(self, vm: str):
+        """
+        A copy of the metadata of the VM, None when it has none.
+        """
+        with self.cond:
+            if vm in self.cache:
+                return copy.deepcopy(self.cache[vm])
+        meta = self.backend.read(vm)
+        with self.cond:
+            # A save while reading wins over what was read
+            meta = self.cache.setdefault(vm, meta)
+            return copy.deepcopy(meta)
+
+    def save(self, vm: str, meta: dict, wait: bool = True):
+        """
+        Store the metadata of the VM. With wait, block until it is on disk
+        and raise the error of the write if it failed.
+        """
+        done = threading.Event() if wait else None
+        with self.cond:
+            self.cache[vm] = copy.deepcopy(meta)
+            self.dirty[vm] = self.cache[vm]
+            if done:
+                self.waiters.append(done)
+            self._start_writer()
+            self.cond.notify()
+        if done:
+            done.wait()
+            if done.error:
+                raise done.error
+
+    def _start_writer(self):
+        # Must be called with cond held
+        if self.writer is None:
+            self.writer = threading.Thread(target=self._write_loop, name="meta-writer", daemon=True)
+            self.writer.start()
+
+    def _write_loop(self):
+        while True:
+            with self.cond:
+                while not self.dirty:
+                    self.cond.wait()
+            # Let concurrent backups add their saves to this batch
+            time.sleep(META_FLUSH_DELAY)
+            with self.cond:
+                batch, self.dirty = self.dirty, {}
+                waiters, self.waiters = self.waiters, []
+
+            error = None
+            try:
+                self.backend.write_many(batch)
+                logger.debug(f"Saved metadata of {len(batch)} VMs")
+            except Exception as e:
+                logger.error(f"Error saving metadata of {list(batch)}: {e}")
+                error = e
+                with self.cond:
+                    # Retried with the next batch unless saved again meanwhile
+                    for vm, meta in batch.items():
+                        self.dirty.setdefault(vm, meta)
+
+            for done in waiters:
+                done.error = error
+                done.set()
+            if error:
+                time.sleep(1)
+
+def _open_store() -> MetaStore:
+    if META_BACKEND == "sqlite":
+        return MetaStore(SqliteBackend(META_DATABASE, META_ROOT))
+    return MetaStore(JsonBackend(META_ROOT))
+
+meta_store = _open_store()
+
+@asynccontextmanager
+async def meta_lock(vm: str):
+    """
+    Lock serialising the calls that read, change and save the metadata of a
+    VM across several awaits. Only used from the event loop.
+    """
+    entry = meta_locks.setdefault(vm, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del meta_locks[vm]
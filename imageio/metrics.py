@@ -0,0 +1,39 @@
+import threading
+
+# =============================
+# In-memory metrics
+# =============================
+
+# name -> {"count", "sum", "min", "max", "last"}
+timings = {}
+# name -> callable returning the current value
+gauges = {}
+_lock = threading.Lock()
+
+def observe(name: str, value: float):
+    """
+    Record one observation of a timing, e.g. seconds until an NBD server was ready.
+    """
+    with _lock:
+        t = timings.get(name)
+        if t is None:
+            timings[name] = {"count": 1, "sum": value, "min": value, "max": value, "last": value}
+            return
+        t["count"] += 1
+        t["sum"] += value
+        t["min"] = min(t["min"], value)
+        t["max"] = max(t["max"], value)
+        t["last"] = value
+
+def register_gauge(name: str, func):
+    """
+    Report the value of func() under name in every snapshot.
+    """
+    gauges[name] = func
+
+def snapshot() -> dict:
+    with _lock:
+        result = {name: dict(t, avg=t["sum"] / t["count"]) for name, t in timings.items()}
+    for name, func in list(gauges.items()):
+        result[name] = func()
+    return result
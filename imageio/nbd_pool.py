@@ -0,0 +1,268 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
+import nbd
+
+from imageio.config import NBD
+from imageio.logging_imageio import logger
+
+# =============================
+# Config
+# =============================
+
+# Advertised to clients in OPTIONS and used as the pool size per transfer
+MAX_READERS = NBD.getint("max_readers", fallback=8)
+MAX_WRITERS = NBD.getint("max_writers", fallback=8)
+
+# Pools not used for this many seconds are closed
+POOL_IDLE_TIMEOUT = NBD.getint("pool_idle_timeout", fallback=300)
+
+# Seconds to wait for a free connection when all of them are busy
+POOL_ACQUIRE_TIMEOUT = NBD.getint("pool_acquire_timeout", fallback=60)
+
+# transfer id -> NBDPool
+nbd_pools = {}
+_pools_lock = threading.Lock()
+
+# =============================
+# Connection pool
+# =============================
+
+class NBDPool:
+    """
+    Pre-connected NBD handles to one export, shared by the requests of a transfer.
+
+    Handles are connected lazily up to `size` and returned to the pool after
+    each request, so the NBD handshake and meta context negotiation happen
+    once per handle instead of once per HTTP request.
+    """
+
+    def __init__(self, socket_path: str, export_name: str = None, meta_contexts: tuple = (), size: int = MAX_READERS, image: str = None):
+        self.socket_path = socket_path
+        self.export_name = export_name
+        self.meta_contexts = tuple(meta_contexts)
+        self.size = size
+        self.image = image
+        self.last_used = time.time()
+        self.closed = False
+        # Idle handles, the most recently returned last
+        self._idle = []
+        self._created = 0
+        self.busy = 0
+        self._broken = set()
+        self._lock = threading.Lock()
+        # Signalled when a handle is returned or closed, either lets a waiter go
+        self._changed = threading.Condition(self._lock)
+        self._export_size = None
+
+    def _connect(self):
+        h = nbd.NBD()
+        for context in self.meta_contexts:
+            h.add_meta_context(context)
+        if self.export_name:
+            h.set_export_name(self.export_name)
+        h.connect_unix(self.socket_path)
+        return h
+
+    def _take(self, wait: bool):
+        # An idle handle, True when a new one may be connected, or None
+        deadline = time.monotonic() + POOL_ACQUIRE_TIMEOUT
+        with self._changed:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if self._created < self.size:
+                    self._created += 1
+                    return True
+                if not wait:
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RuntimeError(f"No NBD connection available for {self.socket_path}")
+                self._changed.wait(remaining)
+
+    def _connect_new(self):
+        # Connect outside the lock, giving the slot back if it fails
+        try:
+            return self._connect()
+        except Exception:
+            with self._changed:
+                self._created -= 1
+                self._changed.notify()
+            raise
+
+    def _acquire(self):
+        h = self._take(wait=True)
+        return self._connect_new() if h is True else h
+
+    def acquire(self):
+        """
+        Borrow a handle, waiting for one if all are busy. Must be paired with release().
+        """
+        h = self._acquire()
+        self._borrowed()
+        return h
+
+    def try_acquire(self):
+        """
+        Borrow a handle only if one is idle or may still be created, otherwise return None.
+        Must be paired with release().
+        """
+        h = self._take(wait=False)
+        if h is None:
+            return None
+        if h is True:
+            h = self._connect_new()
+        self._borrowed()
+        return h
+
+    def release(self, h, healthy: bool = True):
+        """
+        Return a handle borrowed with acquire() or try_acquire().
+        """
+        self._release(h, healthy)
+
+    def _discard(self, h):
+        with self._changed:
+            self._created -= 1
+            # A waiter may connect a new handle in its place
+            self._changed.notify()
+        try:
+            h.close()
+        except Exception as e:
+            logger.debug(f"Error closing NBD connection to {self.socket_path}: {e}")
+
+    def _borrowed(self):
+        with self._lock:
+            self.busy += 1
+        self.last_used = time.time()
+
+    def _release(self, h, healthy: bool):
+        self.last_used = time.time()
+        with self._lock:
+            self.busy -= 1
+            if id(h) in self._broken:
+                self._broken.discard(id(h))
+                healthy = False
+        if healthy and not self.closed:
+            with self._changed:
+                self._idle.append(h)
+                self._changed.notify()
+        else:
+            self._discard(h)
+
+    def discard_on_release(self, h):
+        """
+        Close a borrowed handle instead of returning it, e.g. when commands are still in flight.
+        """
+        with self._lock:
+            self._broken.add(id(h))
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connected handle; it goes back to the pool unless the request failed.
+        """
+        h = self._acquire()
+        self._borrowed()
+        healthy = False
+        try:
+            yield h
+            healthy = True
+        except GeneratorExit:
+            # The client went away between two reads, the handle is still usable
+            healthy = True
+            raise
+        finally:
+            self._release(h, healthy)
+
+    @asynccontextmanager
+    async def aconnection(self):
+        """
+        Same as connection() for coroutines; connecting and waiting happen in a thread.
+        """
+        h = await asyncio.to_thread(self._acquire)
+        self._borrowed()
+        healthy = False
+        try:
+            yield h
+            healthy = True
+        except GeneratorExit:
+            healthy = True
+            raise
+        finally:
+            self._release(h, healthy)
+
+    def get_size(self) -> int:
+        """
+        Virtual size of the export, asked once over a pooled connection.
+        """
+        if self._export_size is None:
+            with self.connection() as h:
+                self._export_size = h.get_size()
+        return self._export_size
+
+    def close(self):
+        """
+        Close the idle handles; busy handles are closed when they are returned.
+        """
+        self.closed = True
+        with self._changed:
+            idle, self._idle = self._idle, []
+        for h in idle:
+            self._discard(h)
+
+# =============================
+# Pool registry
+# =============================
+
+def get_pool(transfer_id: str, socket_path: str, export_name: str = None, meta_contexts: tuple = (), image: str = None, size: int = MAX_READERS) -> NBDPool:
+    """
+    Return the pool of a transfer, creating it on first use.
+    A pool for a different socket or export replaces the old one.
+    """
+    close_idle_pools()
+    with _pools_lock:
+        pool = nbd_pools.get(transfer_id)
+        if pool and not pool.closed and (pool.socket_path, pool.export_name, pool.meta_contexts) == (socket_path, export_name, tuple(meta_contexts)):
+            return pool
+        if pool:
+            pool.close()
+        pool = NBDPool(socket_path, export_name, meta_contexts, size, image)
+        nbd_pools[transfer_id] = pool
+        logger.debug(f"Created NBD connection pool for transfer {transfer_id} on {socket_path}")
+        return pool
+
+def close_pool(transfer_id: str):
+    with _pools_lock:
+        pool = nbd_pools.pop(transfer_id, None)
+    if pool:
+        pool.close()
+        logger.debug(f"Closed NBD connection pool for transfer {transfer_id}")
+
+def close_image_pools(image: str):
+    """
+    Close the pools of all transfers of an image, e.g. before its NBD server is stopped.
+    """
+    with _pools_lock:
+        transfer_ids = [tid for tid, pool in nbd_pools.items() if pool.image == image]
+    for transfer_id in transfer_ids:
+        close_pool(transfer_id)
+
+def close_socket_pools(socket_path: str):
+    """
+    Close the pools connected to a socket, e.g. before its NBD server is stopped.
+    """
+    with _pools_lock:
+        transfer_ids = [tid for tid, pool in nbd_pools.items() if pool.socket_path == socket_path]
+    for transfer_id in transfer_ids:
+        close_pool(transfer_id)
+
+def close_idle_pools(timeout: int = POOL_IDLE_TIMEOUT):
+    now = time.time()
+    with _pools_lock:
+        transfer_ids = [tid for tid, pool in nbd_pools.items() if not pool.busy and now - pool.last_used > timeout]
+    for transfer_id in transfer_ids:
+        close_pool(transfer_id)
@@ -0,0 +1,340 @@
+import asyncio
+import glob
+import os
+import socket
+import subprocess
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from imageio.config import NBD
+from imageio.logging_imageio import logger
+from imageio.metrics import observe
+from imageio.nbd_pool import nbd_pools, close_socket_pools
+from imageio.scheduler import server_slots
+
+# =============================
+# Config
+# =============================
+
+# qemu-nbd servers without users for this many seconds are stopped
+SERVER_IDLE_TIMEOUT = NBD.getint("server_idle_timeout", fallback=300)
+
+# Seconds to wait for a new qemu-nbd to accept connections
+SERVER_START_TIMEOUT = NBD.getint("server_start_timeout", fallback=5)
+
+SOCKET_DIR = "/tmp"
+
+# Every NBD server greets new clients with these 8 bytes
+NBD_MAGIC = b"NBDMAGIC"
+
+# Delays between two readiness probes: first, factor, maximum
+PROBE_DELAY = 0.005
+PROBE_BACKOFF = 2
+PROBE_MAX_DELAY = 0.1
+
+# (image, bitmap, read only) -> NBDServer
+nbd_servers = {}
+# (image, bitmap, read only) -> threading.Event set once its server started or failed to
+_starting = {}
+_servers_lock = threading.Lock()
+_reaper = None
+
+# =============================
+# qemu-nbd servers
+# =============================
+
+class NBDServer:
+    """
+    A qemu-nbd process exporting an image, shared by every extents, download
+    and upload call that needs the same (image, bitmap, read only) export.
+    """
+
+    def __init__(self, image: str, bitmap: str = None, read_only: bool = True):
+        self.image = image
+        self.bitmap = bitmap
+        self.read_only = read_only
+        self.socket_path = os.path.join(SOCKET_DIR, f"nbd-{os.path.basename(image)}--{uuid.uuid4().hex}.sock")
+        self.proc = None
+        self.refs = 0
+        self.last_used = time.time()
+        # Whether the server holds one of the host's server slots
+        self.slot = False
+
+    @property
+    def key(self) -> tuple:
+        return (self.image, self.bitmap, self.read_only)
+
+    def start(self):
+        cmd = ["qemu-nbd", "-f", "qcow2"]
+        if self.read_only:
+            cmd.append("--read-only")
+        else:
+            # Let zero requests of restores punch holes, keeping the image sparse
+            cmd.append("--discard=unmap")
+        cmd.extend(["--persistent", f"--socket={self.socket_path}", "--shared", "100"])
+        if self.bitmap:
+            cmd.append(f"--bitmap={self.bitmap}")
+        cmd.append(self.image)
+        logger.debug(f"Starting NBD server: {cmd}")
+        self.proc = subprocess.Popen(cmd)
+        try:
+            wait_for_nbd(self.socket_path, SERVER_START_TIMEOUT, self.proc, metric="qemu_nbd_ready_seconds")
+        except Exception:
+            self.stop()
+            raise
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None and os.path.exists(self.socket_path)
+
+    def in_use(self) -> bool:
+        """
+        Whether a call holds the server or a pooled connection to it is borrowed.
+        """
+        return self.refs > 0 or any(pool.busy for pool in list(nbd_pools.values()) if pool.socket_path == self.socket_path)
+
+    def stop(self):
+        if self.slot:
+            self.slot = False
+            server_slots.release()
+        close_socket_pools(self.socket_path)
+        if self.proc and self.proc.poll() is None:
+            logger.debug(f"Terminating NBD server for image {self.image} with proc {self.proc}")
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        try:
+            os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+# =============================
+# Readiness
+# =============================
+
+def probe_nbd(path: str) -> bool:
+    """
+    Whether an NBD server accepts connections on the socket and greets them.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(1)
+    try:
+        s.connect(path)
+        return s.recv(len(NBD_MAGIC), socket.MSG_WAITALL) == NBD_MAGIC
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+async def probe_nbd_async(path: str) -> bool:
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(path), 1)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        return await asyncio.wait_for(reader.readexactly(len(NBD_MAGIC)), 1) == NBD_MAGIC
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        return False
+    finally:
+        writer.close()
+
+def _check_proc(path: str, proc):
+    if proc is not None and proc.poll() not in (None, 0):
+        raise RuntimeError(f"NBD server for {path} exited with code {proc.returncode}")
+
+def wait_for_nbd(path, timeout=5.0, proc=None, metric: str = None) -> float:
+    """
+    Wait until the NBD server on path accepts connections, probing with
+    backoff. Fails early when proc exits with an error. Returns the seconds
+    waited, which are also recorded under metric.
+    """
+    started = time.monotonic()
+    delay = PROBE_DELAY
+    while not probe_nbd(path):
+        _check_proc(path, proc)
+        if time.monotonic() - started > timeout:
+            raise RuntimeError(f"NBD socket not accepting connections: {path}")
+        time.sleep(delay)
+        delay = min(delay * PROBE_BACKOFF, PROBE_MAX_DELAY)
+    waited = time.monotonic() - started
+    if metric:
+        observe(metric, waited)
+    return waited
+
+async def wait_for_nbd_async(path, timeout=5.0, proc=None, metric: str = None) -> float:
+    """
+    Same as wait_for_nbd() without blocking the event loop.
+    """
+    started = time.monotonic()
+    delay = PROBE_DELAY
+    while not await probe_nbd_async(path):
+        _check_proc(path, proc)
+        if time.monotonic() - started > timeout:
+            raise RuntimeError(f"NBD socket not accepting connections: {path}")
+        await asyncio.sleep(delay)
+        delay = min(delay * PROBE_BACKOFF, PROBE_MAX_DELAY)
+    waited = time.monotonic() - started
+    if metric:
+        observe(metric, waited)
+    return waited
+
+# =============================
+# Server registry
+# =============================
+
+def _use(server: NBDServer, hold: bool) -> NBDServer:
+    # Must be called with _servers_lock held
+    server.last_used = time.time()
+    if hold:
+        server.refs += 1
+    return server
+
+def _get_server(image: str, bitmap: str, read_only: bool, hold: bool = False) -> NBDServer:
+    """
+    Return the running server for the export, starting it once the host has
+    a free server slot. With hold, the caller holds it until released.
+    The server is started without the registry lock; other callers of the
+    export wait for it on its starting event.
+    """
+    key = (image, bitmap, read_only)
+    slot = False
+    try:
+        while True:
+            dead = None
+            with _servers_lock:
+                server = nbd_servers.get(key)
+                if server and not server.alive():
+                    dead, server = nbd_servers.pop(key), None
+                if server:
+                    return _use(server, hold)
+                starting = _starting.get(key)
+                claimed = starting is None and slot
+                if claimed:
+                    starting = _starting[key] = threading.Event()
+
+            if dead:
+                logger.warning(f"NBD server for image {image} is gone, starting a new one")
+                dead.stop()
+
+            if claimed:
+                server = NBDServer(image, bitmap, read_only)
+                try:
+                    server.start()
+                    with _servers_lock:
+                        server.slot, slot = True, False
+                        nbd_servers[key] = server
+                        _start_reaper()
+                        _use(server, hold)
+                    logger.debug(f"Started NBD server for image {image} with socket {server.socket_path}")
+                    return server
+                finally:
+                    with _servers_lock:
+                        del _starting[key]
+                    starting.set()
+            elif starting:
+                # Another call is starting the server, look again once it is up or failed
+                starting.wait()
+            else:
+                # Wait for a slot without the lock, stopping idle servers to make room
+                server_slots.acquire(image, while_waiting=stop_idle_server)
+                slot = True
+    finally:
+        if slot:
+            server_slots.release()
+
+def ensure_server(image: str, bitmap: str = None, read_only: bool = True) -> str:
+    """
+    Return the socket of the NBD server for the export, starting it if needed.
+    """
+    return _get_server(image, bitmap, read_only).socket_path
+
+def running_server(image: str, bitmap: str = None, read_only: bool = True):
+    with _servers_lock:
+        server = nbd_servers.get((image, bitmap, read_only))
+    return server if server and server.alive() else None
+
+@contextmanager
+def use_server(image: str, bitmap: str = None, read_only: bool = True):
+    """
+    Hold the NBD server for the export while the block runs, yielding its socket.
+    """
+    server = _get_server(image, bitmap, read_only, hold=True)
+    try:
+        yield server.socket_path
+    finally:
+        with _servers_lock:
+            server.refs -= 1
+            server.last_used = time.time()
+
+def stop_image_servers(image: str):
+    """
+    Stop every NBD server of an image, e.g. when its transfer is finished.
+    """
+    with _servers_lock:
+        servers = [s for key, s in nbd_servers.items() if key[0] == image]
+        for server in servers:
+            del nbd_servers[server.key]
+    for server in servers:
+        server.stop()
+
+def reap_idle_servers(timeout: int = SERVER_IDLE_TIMEOUT):
+    now = time.time()
+    with _servers_lock:
+        idle = [s for s in nbd_servers.values() if not s.in_use() and now - s.last_used > timeout]
+        for server in idle:
+            del nbd_servers[server.key]
+    for server in idle:
+        logger.debug(f"Stopping idle NBD server for image {server.image}")
+        server.stop()
+
+def stop_idle_server():
+    """
+    Stop the least recently used server nobody uses, when the host is out of
+    server slots.
+    """
+    with _servers_lock:
+        idle = [s for s in nbd_servers.values() if not s.in_use()]
+        if not idle:
+            return
+        server = min(idle, key=lambda s: s.last_used)
+        del nbd_servers[server.key]
+    logger.debug(f"Stopping idle NBD server for image {server.image} to start another one")
+    server.stop()
+
+def _reap_loop():
+    while True:
+        time.sleep(max(1, min(SERVER_IDLE_TIMEOUT // 2, 30)))
+        try:
+            reap_idle_servers()
+        except Exception as e:
+            logger.error(f"Error stopping idle NBD servers: {e}")
+
+def _start_reaper():
+    global _reaper
+    if _reaper is None:
+        _reaper = threading.Thread(target=_reap_loop, name="nbd-server-reaper", daemon=True)
+        _reaper.start()
+
+def cleanup_stale_sockets():
+    """
+    Remove NBD sockets left behind by servers that are gone, e.g. after a restart.
+    Sockets somebody still listens on, like those of libvirt backup jobs, are kept.
+    """
+    for path in glob.glob(os.path.join(SOCKET_DIR, "nbd-*.sock")):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            try:
+                os.remove(path)
+                logger.info(f"Removed stale NBD socket {path}")
+            except OSError as e:
+                logger.warning(f"Cannot remove stale NBD socket {path}: {e}")
+        except OSError:
+            pass
+        finally:
+            s.close()
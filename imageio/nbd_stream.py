@@ -0,0 +1,239 @@
+import asyncio
+from collections import deque
+from contextlib import aclosing
+
+import nbd
+
+from imageio.config import NBD
+from imageio.extents import zero_chunks
+from imageio.logging_imageio import logger
+
+# =============================
+# Config
+# =============================
+
+# Size of a single NBD read, also the size of the chunks sent to the client
+READ_CHUNK_SIZE = NBD.getint("chunk_size", fallback=2 * 1024 * 1024)
+
+# Number of reads kept in flight on one NBD connection
+QUEUE_DEPTH = NBD.getint("queue_depth", fallback=8)
+
+# Ranges are split in stripes of this size and read over several connections
+STRIPE_SIZE = NBD.getint("stripe_size", fallback=64 * 1024 * 1024)
+
+# Connections used for one range; 0 picks one connection per STRIPE_SIZE of data, up to MAX_STRIPE_CONNECTIONS
+STRIPE_CONNECTIONS = NBD.getint("stripe_connections", fallback=0)
+MAX_STRIPE_CONNECTIONS = NBD.getint("max_stripe_connections", fallback=4)
+
+# =============================
+# asyncio integration of a libnbd handle
+# =============================
+
+# aio_pread and aio_pwrite are given plain bytes-like objects, which the
+# Python binding of libnbd 1.14 and later accepts without nbd.Buffer copies;
+# it keeps them referenced until their command completes
+
+class AioHandle:
+    """
+    Drives the libnbd state machine of a handle from the asyncio event loop.
+
+    The handle's socket is watched with add_reader/add_writer according to
+    aio_get_direction(), and coroutines waiting for a command are woken up
+    whenever libnbd made progress.
+    """
+
+    def __init__(self, h):
+        self.h = h
+        self.loop = asyncio.get_running_loop()
+        self.fd = h.aio_get_fd()
+        self._writing = False
+        self._waiter = None
+        self.loop.add_reader(self.fd, self._on_readable)
+
+    def _on_readable(self):
+        self.h.aio_notify_read()
+        self._progress()
+
+    def _on_writable(self):
+        self.h.aio_notify_write()
+        self._progress()
+
+    def update_interest(self):
+        """
+        Watch for writability only while libnbd has data to send.
+        """
+        want_write = bool(self.h.aio_get_direction() & nbd.AIO_DIRECTION_WRITE)
+        if want_write and not self._writing:
+            self.loop.add_writer(self.fd, self._on_writable)
+        elif not want_write and self._writing:
+            self.loop.remove_writer(self.fd)
+        self._writing = want_write
+
+    def _progress(self):
+        self.update_interest()
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def wait(self, cookie: int):
+        """
+        Wait until the command with the given cookie completed.
+        Raises nbd.Error if the command failed.
+        """
+        while not self.h.aio_command_completed(cookie):
+            self._waiter = self.loop.create_future()
+            self.update_interest()
+            await self._waiter
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+        if self._writing:
+            self.loop.remove_writer(self.fd)
+            self._writing = False
+
+# =============================
+# Range reader
+# =============================
+
+async def _aio_read(pool, h, start: int, length: int, queue_depth: int, chunk_size: int):
+    """
+    Yield the bytes of [start, start + length) in order, keeping up to
+    queue_depth aio_pread commands in flight on a borrowed handle.
+    """
+    aio = AioHandle(h)
+    pending = deque()
+    offset = start
+    end = start + length
+    try:
+        while pending or offset < end:
+            while offset < end and len(pending) < queue_depth:
+                n = min(chunk_size, end - offset)
+                buf = bytearray(n)
+                pending.append((h.aio_pread(buf, offset), buf))
+                offset += n
+
+            cookie, buf = pending[0]
+            await aio.wait(cookie)
+            pending.popleft()
+            yield memoryview(buf)
+    finally:
+        aio.close()
+        if pending:
+            # The connection still has reads in flight, do not reuse it
+            logger.debug(f"Dropping NBD connection with {len(pending)} reads in flight")
+            pool.discard_on_release(h)
+
+async def aio_read_range(pool, start: int, length: int, queue_depth: int = QUEUE_DEPTH, chunk_size: int = READ_CHUNK_SIZE):
+    """
+    Yield the bytes of [start, start + length) in order from one pooled connection.
+    """
+    async with pool.aconnection() as h:
+        # Closed before the handle goes back, so reads in flight mark it broken
+        async with aclosing(_aio_read(pool, h, start, length, queue_depth, chunk_size)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+# =============================
+# Striped reader
+# =============================
+
+def auto_connections(data_length: int) -> int:
+    """
+    Number of connections worth using for a range with data_length bytes to read.
+    """
+    if STRIPE_CONNECTIONS > 0:
+        return STRIPE_CONNECTIONS
+    return max(1, min(MAX_STRIPE_CONNECTIONS, data_length // STRIPE_SIZE))
+
+async def striped_read_range(pool, start: int, length: int, connections: int = None, stripe_size: int = STRIPE_SIZE):
+    """
+    Yield the bytes of [start, start + length) in order, reading consecutive
+    stripes in parallel over several pooled connections.
+
+    Stripe k is read by connection k % n. Each connection buffers at most
+    queue_depth chunks ahead of the client, so memory stays bounded.
+    """
+    n = connections or auto_connections(length)
+    n = min(n, pool.size, -(-length // stripe_size))
+    if n <= 1:
+        async with aclosing(aio_read_range(pool, start, length)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+        return
+
+    # Only the first connection waits for the pool, extra ones are used when
+    # free, so concurrent striped streams cannot deadlock on each other
+    h = await asyncio.to_thread(pool.try_acquire)
+    handles = [h or await asyncio.to_thread(pool.acquire)]
+    while len(handles) < n:
+        h = await asyncio.to_thread(pool.try_acquire)
+        if h is None:
+            break
+        handles.append(h)
+    n = len(handles)
+
+    stripes = [(offset, min(stripe_size, start + length - offset)) for offset in range(start, start + length, stripe_size)]
+    queues = [asyncio.Queue(maxsize=QUEUE_DEPTH) for _ in range(n)]
+    end_of_stripe = object()
+
+    async def pump(i: int):
+        # Read the stripes of connection i in order into its queue
+        # Readers are closed when the pump is cancelled, so their handles are
+        # marked broken and unwatched before being released
+        for stripe_start, stripe_length in stripes[i::n]:
+            async with aclosing(_aio_read(pool, handles[i], stripe_start, stripe_length, QUEUE_DEPTH, READ_CHUNK_SIZE)) as chunks:
+                async for chunk in chunks:
+                    await queues[i].put(chunk)
+            await queues[i].put(end_of_stripe)
+
+    async def next_chunk(i: int):
+        q, task = queues[i], tasks[i]
+        while q.empty():
+            if task.done():
+                # The pump ended without producing this stripe, re-raise its error
+                task.result()
+                raise RuntimeError(f"NBD stripe reader {i} stopped early")
+            get = asyncio.create_task(q.get())
+            done, _ = await asyncio.wait([get, task], return_when=asyncio.FIRST_COMPLETED)
+            if get in done:
+                return get.result()
+            get.cancel()
+        return q.get_nowait()
+
+    tasks = [asyncio.create_task(pump(i)) for i in range(n)]
+    healthy = True
+    try:
+        for k in range(len(stripes)):
+            while (chunk := await next_chunk(k % n)) is not end_of_stripe:
+                yield chunk
+    except GeneratorExit:
+        raise
+    except BaseException:
+        healthy = False
+        raise
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for h in handles:
+            pool.release(h, healthy)
+
+# =============================
+# Sparse reader
+# =============================
+
+async def sparse_read_range(pool, segments: list):
+    """
+    Yield the bytes of consecutive (offset, length, zero) segments in order.
+    Zero segments are sent from the shared zero buffer without reading them,
+    data segments are read over NBD.
+    """
+    data_length = sum(length for _, length, zero in segments if not zero)
+    connections = auto_connections(data_length)
+    for offset, length, zero in segments:
+        if zero:
+            for chunk in zero_chunks(length):
+                yield chunk
+        else:
+            async with aclosing(striped_read_range(pool, offset, length, connections)) as chunks:
+                async for chunk in chunks:
+                    yield chunk
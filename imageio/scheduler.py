@@ -0,0 +1,176 @@
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+from starlette.concurrency import iterate_in_threadpool
+
+from imageio.config import NBD
+from imageio.metrics import register_gauge
+from imageio.throttle import throttle, consume, start_request
+
+# =============================
+# Config
+# =============================
+
+# Host-wide limits, 0 means unlimited
+MAX_BACKUPS = NBD.getint("max_backups", fallback=8)
+MAX_NBD_SERVERS = NBD.getint("max_nbd_servers", fallback=64)
+MAX_STREAMS = NBD.getint("max_streams", fallback=32)
+
+# =============================
+# Fair limiter
+# =============================
+
+class _Waiter:
+
+    def __init__(self, key, loop=None):
+        self.key = key
+        self.granted = False
+        if loop:
+            self.loop = loop
+            self.future = loop.create_future()
+        else:
+            self.loop = None
+            self.event = threading.Event()
+
+    def wake(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._resolve)
+        else:
+            self.event.set()
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+class FairLimiter:
+    """
+    At most limit holders on the host. Waiters are queued per key, e.g. per
+    transfer, and freed slots go round robin over the keys, so one transfer
+    with many requests cannot starve the others. Used from threads and from
+    the event loop.
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        # key -> waiters, in the order the keys are served
+        self.queues = OrderedDict()
+        self.lock = threading.Lock()
+        register_gauge(f"{name}_active", lambda: self.active)
+        register_gauge(f"{name}_queued", self.queue_depths)
+
+    def queue_depths(self) -> dict:
+        with self.lock:
+            return {str(key): len(q) for key, q in self.queues.items()}
+
+    def _enter(self, waiter: _Waiter) -> bool:
+        # Take a free slot, or queue the waiter
+        with self.lock:
+            if self.limit <= 0 or (self.active < self.limit and not self.queues):
+                self.active += 1
+                return True
+            self.queues.setdefault(waiter.key, deque()).append(waiter)
+            return False
+
+    def _next_waiter(self):
+        # Must be called with lock held
+        if not self.queues:
+            return None
+        key, q = next(iter(self.queues.items()))
+        waiter = q.popleft()
+        if q:
+            self.queues.move_to_end(key)
+        else:
+            del self.queues[key]
+        return waiter
+
+    def _remove(self, waiter: _Waiter):
+        # Must be called with lock held
+        q = self.queues.get(waiter.key)
+        q.remove(waiter)
+        if not q:
+            del self.queues[waiter.key]
+
+    def release(self):
+        with self.lock:
+            waiter = self._next_waiter()
+            if waiter is None:
+                self.active -= 1
+                return
+            # The slot passes to the waiter
+            waiter.granted = True
+        waiter.wake()
+
+    def acquire(self, key, while_waiting=None, interval: float = 1.0):
+        """
+        Block until a slot is free, calling while_waiting() now and every
+        interval seconds meanwhile, e.g. to free idle resources.
+        """
+        waiter = _Waiter(key)
+        if self._enter(waiter):
+            return
+        while True:
+            if while_waiting:
+                while_waiting()
+            if waiter.event.wait(interval):
+                return
+
+    async def acquire_async(self, key):
+        waiter = _Waiter(key, asyncio.get_running_loop())
+        if self._enter(waiter):
+            return
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self.lock:
+                granted = waiter.granted
+                if not granted:
+                    self._remove(waiter)
+            if granted:
+                self.release()
+            raise
+
+    @contextmanager
+    def slot(self, key):
+        self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def slot_async(self, key):
+        await self.acquire_async(key)
+        try:
+            yield
+        finally:
+            self.release()
+
+# =============================
+# Host limits
+# =============================
+
+# Backup and finalize requests being processed, per VM
+backup_slots = FairLimiter("backups", MAX_BACKUPS)
+# qemu-nbd servers started by the service, per image
+server_slots = FairLimiter("nbd_servers", MAX_NBD_SERVERS)
+# Download and upload streams, per transfer
+stream_slots = FairLimiter("streams", MAX_STREAMS)
+
+async def limit_stream(key, chunks, path: str = None):
+    """
+    Stream chunks while holding a stream slot of the transfer, at the request
+    and byte rates allowed for the transfer and the storage pool of path.
+    Chunks of a plain iterator are read in the thread pool.
+    """
+    await start_request(key, path)
+    buckets = throttle.buckets(key, path)
+    async with stream_slots.slot_async(key):
+        if not hasattr(chunks, "__aiter__"):
+            chunks = iterate_in_threadpool(chunks)
+        async for chunk in chunks:
+            await consume(buckets, len(chunk))
+            yield chunk
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import uuid
 import subprocess
@@ -11,8 +12,15 @@ from imageio.logging_imageio import setup_logging
 from app.security.certs import ensure_certificates
 from app.security.certs import get_default_ip
 from imageio.config import IMAGEIO, SSL, LOGGING
-from imageio.backup_service import backup_router, get_extents_for_backup, download_via_nbd, get_virtual_size, CHUNK_SIZE, upload_via_nbd, shutdown_nbd_server
+from imageio.backup_service import backup_router, get_extents_for_backup, download_via_nbd, CHUNK_SIZE, upload_via_nbd, zero_via_nbd, flush_via_nbd, shutdown_nbd_server
 from imageio.utils import check_internal_auth
+from imageio.nbd_pool import MAX_READERS, MAX_WRITERS
+from imageio.upload_stream import upload_to_file, zero_file, flush_file
+from imageio.file_stream import download_file
+from imageio.nbd_server import cleanup_stale_sockets
+from imageio.metrics import snapshot
+from imageio.throttle import limits, update_limits
+from imageio.image_info import get_virtual_size
 from app.utils.response_builder import create_response
 from app.utils.request_logging import RequestLoggingMiddleware
 
@@ -26,6 +34,9 @@ logger.info("Starting oVirt ImageIO Server")
 cert_file, key_file, ca_cert_file = ensure_certificates()
 logger.info(f"Using certificates: {cert_file}, {key_file}, CA: {ca_cert_file}")
 
+# NBD sockets of servers from a previous run
+cleanup_stale_sockets()
+
 # Get bind IP
 bind_ip = IMAGEIO.get("host", "0.0.0.0")
 public_ip = IMAGEIO.get("public_ip", "").strip()
@@ -111,6 +122,39 @@ def create_download_transfer(payload: dict, request: Request):
         "extents_url": f"https://{bind_ip}:54322/images/{transfer_id}/extents"
     }
 
+# ---- Metrics ----
+
+@imageio_router.get("/internal/metrics")
+def get_metrics(request: Request):
+    if not check_internal_auth(request, INTERNAL_TOKEN):
+        raise HTTPException(status_code=401, detail="Unauthorized: Invalid internal token")
+    return JSONResponse(content=snapshot())
+
+# ---- Throttle ----
+
+@imageio_router.get("/internal/throttle")
+def get_throttle(request: Request):
+    if not check_internal_auth(request, INTERNAL_TOKEN):
+        raise HTTPException(status_code=401, detail="Unauthorized: Invalid internal token")
+    return JSONResponse(content=limits())
+
+@imageio_router.put("/internal/throttle")
+def set_throttle(payload: dict, request: Request):
+    """
+    Change the bandwidth limits in bytes per second, e.g.
+    {"rate": 0, "pool_rate": 0, "transfer_rate": 0, "pools": {storageid: rate}, "transfers": {transfer_id: rate}}
+    and the request limits per second with the same keys under "iops".
+    Only the given keys change; a pool or transfer set to null uses the default again.
+    """
+    if not check_internal_auth(request, INTERNAL_TOKEN):
+        raise HTTPException(status_code=401, detail="Unauthorized: Invalid internal token")
+    try:
+        update_limits(payload)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logger.info(f"Throttle limits changed: {limits()}")
+    return JSONResponse(content=limits())
+
 # ---- Create upload transfer ----
 
 @imageio_router.post("/internal/upload")
@@ -186,6 +230,10 @@ def download_transfer(transfer_id: str, request: Request):
     vm_name = t.get("vm_name")
     file_path = t["file_path"]
 
+    # Outside of backups, raw volumes and cow downloads are the file bytes as they are
+    if not t.get("backup_id") and (t["volume_format"] == "raw" or t["request_format"] == "cow"):
+        return download_file(file_path, request, transfer_id)
+
     return download_via_nbd(vm_name, file_path, request, transfer_id)
 
 # ---- UPLOAD / RESTORE (PUT with Range) ----
@@ -202,29 +250,8 @@ async def upload_transfer(transfer_id: str, request: Request):
     request_format = t["request_format"]
 
     # if format is cow, the original file is already created as a sparse file, so we can just write to it based on the ranges.
-    range_header = request.headers.get("content-range")
-    if request_format == "cow" and not range_header:
-        with open(file_path, "r+b") as f:
-            async for chunk in request.stream():
-                if not chunk:
-                    continue
-                f.write(chunk)
-
-    elif request_format == "cow" and range_header:
-        # Example: bytes 2097152-2162687/3758096384
-        _, range_part = range_header.split(" ")
-        range_and_size = range_part.split("/")
-        range_only = range_and_size[0]  # This will be "2097152-2162687"
-        start_s, end_s = range_only.split("-")
-        start = int(start_s)
-        end = int(end_s)
-
-        with open(file_path, "r+b") as f:
-            f.seek(start)
-            async for chunk in request.stream():
-                if not chunk:
-                    continue
-                f.write(chunk)
+    if request_format == "cow":
+        await upload_to_file(file_path, request, transfer_id)
 
     # if format is raw, the raw data is sent. We need to setup a NBD server to receive the data and write to the file.
     # We need to method upload_range_via_nbd which is similar as download_range.
@@ -246,23 +273,55 @@ async def options_imageio(transfer_id: str, request: Request):
     capabilities = {
         "unix_socket": "\u0000/org/ovirt/imageio",
         "features": ["extents", "zero", "flush"],
-        "max_readers": 8,
-        "max_writers": 8
+        "max_readers": MAX_READERS,
+        "max_writers": MAX_WRITERS
     }
     return JSONResponse(content=capabilities, status_code=200)
 
 @imageio_router.patch("/{transfer_id}")
 async def patch_imageio(transfer_id: str, request: Request):
+    """
+    PATCH operations of the imageio API:
+    {"op": "zero", "offset": 0, "size": 1073741824, "flush": false} or {"op": "flush"}
+    """
     # get data from request
     data = await request.json()
     logger.info(f"Patching tranfer {transfer_id} with data: {data}")
 
     t = transfers.get(transfer_id)
-    if t and t["mode"] == "upload" and t["request_format"] == "raw":
-        # For upload, we need to stop the NBD server after upload is done, so we can finalize the qcow2 file and make it ready for use.
-        logger.info(f"Stopping NBD process for transfer {transfer_id}")
-        file_path = t["file_path"]
-        shutdown_nbd_server(file_path)
+    if not t or t["mode"] != "upload":
+        raise HTTPException(404)
+
+    file_path = t["file_path"]
+    request_format = t["request_format"]
+    op = data.get("op")
+
+    if op == "zero":
+        try:
+            offset = int(data.get("offset", 0))
+            size = int(data["size"])
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="zero requires an integer size and offset")
+        if offset < 0 or size < 0:
+            raise HTTPException(status_code=400, detail="Invalid zero range")
+        flush = bool(data.get("flush", False))
+
+        if request_format == "raw":
+            await zero_via_nbd(file_path, transfer_id, offset, size, flush)
+        else:
+            await zero_file(file_path, transfer_id, offset, size, flush)
+
+    elif op == "flush":
+        if request_format == "raw":
+            await flush_via_nbd(file_path, transfer_id)
+            # The upload is done, stop the NBD server so the qcow2 file is finalized and ready for use.
+            logger.info(f"Stopping NBD process for transfer {transfer_id}")
+            await asyncio.to_thread(shutdown_nbd_server, file_path)
+        else:
+            await flush_file(file_path, transfer_id)
+
+    else:
+        raise HTTPException(status_code=400, detail=f"Unsupported operation: {op}")
 
     return Response(status_code=200)
 
@@ -0,0 +1,243 @@
+import asyncio
+import threading
+import time
+
+from imageio.config import THROTTLE
+from imageio.metrics import observe
+
+# =============================
+# Config
+# =============================
+
+# Bytes per second, 0 means unlimited. Changed at runtime with /internal/throttle
+RATE = THROTTLE.getint("rate", fallback=0)
+POOL_RATE = THROTTLE.getint("pool_rate", fallback=0)
+TRANSFER_RATE = THROTTLE.getint("transfer_rate", fallback=0)
+
+# Requests per second, 0 means unlimited. A download, upload, zero or flush
+# request is one operation, whatever its size
+IOPS = THROTTLE.getint("iops", fallback=0)
+POOL_IOPS = THROTTLE.getint("pool_iops", fallback=0)
+TRANSFER_IOPS = THROTTLE.getint("transfer_iops", fallback=0)
+
+# Buckets and rates of transfers unused for this many seconds are forgotten
+TRANSFER_IDLE_TIMEOUT = 600
+
+# =============================
+# Token buckets
+# =============================
+
+class TokenBucket:
+    """
+    Lets rate tokens (bytes or requests) per second through with bursts of
+    up to one second of traffic. Callers take tokens first and sleep off the debt afterwards.
+    """
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = time.monotonic()
+        # Last time tokens were taken, also while the rate is unlimited
+        self.used = self.stamp
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        # Must be called with lock held
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def set_rate(self, rate: int):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    def reserve(self, n: int) -> float:
+        """
+        Take n tokens, returning the seconds to wait before using them.
+        """
+        with self.lock:
+            self.used = time.monotonic()
+            if self.rate <= 0:
+                return 0
+            self._refill()
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+# =============================
+# Host, storage pool and transfer limits
+# =============================
+
+class Throttle:
+    """
+    Token buckets for the whole host, each storage pool and each transfer.
+    Pools and transfers use the default rate unless set on their own.
+    Transfers idle in follow too are the only ones forgotten.
+    """
+
+    def __init__(self, rate: int, pool_rate: int, transfer_rate: int, follow: "Throttle" = None):
+        self.host = TokenBucket(rate)
+        self.follow = follow
+        self.pool_rate = pool_rate
+        self.transfer_rate = transfer_rate
+        # Rates set for single pools and transfers
+        self.pool_rates = {}
+        self.transfer_rates = {}
+        self.pools = {}
+        self.transfers = {}
+        self.lock = threading.Lock()
+
+    def _pool(self, pool: str) -> TokenBucket:
+        bucket = self.pools.get(pool)
+        if bucket is None:
+            bucket = self.pools[pool] = TokenBucket(self.pool_rates.get(pool, self.pool_rate))
+        return bucket
+
+    def _idle(self, transfer_id: str, bucket: TokenBucket, now: float) -> bool:
+        # Requests take one op when they start, so the op bucket of a long
+        # stream is kept while its bytes still go through follow
+        used = bucket.used
+        if self.follow is not None:
+            other = self.follow.transfers.get(transfer_id)
+            if other is not None:
+                used = max(used, other.used)
+        return now - used > TRANSFER_IDLE_TIMEOUT
+
+    def _prune(self):
+        # Must be called with lock held. Streams take tokens for every chunk,
+        # so the buckets of running ones are never idle
+        now = time.monotonic()
+        for transfer_id, bucket in list(self.transfers.items()):
+            if self._idle(transfer_id, bucket, now):
+                del self.transfers[transfer_id]
+                self.transfer_rates.pop(transfer_id, None)
+
+    def _transfer(self, transfer_id: str) -> TokenBucket:
+        bucket = self.transfers.get(transfer_id)
+        if bucket is None:
+            self._prune()
+            bucket = self.transfers[transfer_id] = TokenBucket(self.transfer_rates.get(transfer_id, self.transfer_rate))
+        return bucket
+
+    def buckets(self, transfer_id: str = None, path: str = None) -> list:
+        """
+        The buckets the data or requests of a transfer of the image at path go through.
+        """
+        with self.lock:
+            buckets = [self.host]
+            pool = storage_pool(path)
+            if pool:
+                buckets.append(self._pool(pool))
+            if transfer_id:
+                buckets.append(self._transfer(transfer_id))
+            return buckets
+
+    def limits(self) -> dict:
+        with self.lock:
+            return {
+                "rate": self.host.rate,
+                "pool_rate": self.pool_rate,
+                "transfer_rate": self.transfer_rate,
+                "pools": dict(self.pool_rates),
+                "transfers": dict(self.transfer_rates),
+            }
+
+    @staticmethod
+    def check(limits: dict):
+        """
+        Raise ValueError if limits are not valid for update().
+        """
+        for key in ("rate", "pool_rate", "transfer_rate"):
+            if key in limits:
+                _check_rate(key, limits[key])
+        for key in ("pools", "transfers"):
+            if not isinstance(limits.get(key, {}), dict):
+                raise ValueError(f"Invalid {key}: {limits[key]}")
+            for name, rate in limits.get(key, {}).items():
+                if rate is not None:
+                    _check_rate(f"{key}.{name}", rate)
+
+    def update(self, limits: dict):
+        """
+        Change the rates, also for the streams running.
+        Takes the keys of limits(); a pool or transfer set to None goes back
+        to the default rate.
+        """
+        self.check(limits)
+        with self.lock:
+            if "rate" in limits:
+                self.host.set_rate(limits["rate"])
+            self.pool_rate = limits.get("pool_rate", self.pool_rate)
+            self.transfer_rate = limits.get("transfer_rate", self.transfer_rate)
+            _set_rates(self.pool_rates, limits.get("pools", {}))
+            self._prune()
+            _set_rates(self.transfer_rates, limits.get("transfers", {}))
+            # Rates set before a transfer starts are forgotten with its bucket
+            for transfer_id in self.transfer_rates:
+                if transfer_id not in self.transfers:
+                    self.transfers[transfer_id] = TokenBucket(self.transfer_rate)
+            for pool, bucket in self.pools.items():
+                bucket.set_rate(self.pool_rates.get(pool, self.pool_rate))
+            for transfer_id, bucket in self.transfers.items():
+                bucket.set_rate(self.transfer_rates.get(transfer_id, self.transfer_rate))
+
+def _check_rate(name: str, rate):
+    if not isinstance(rate, int) or isinstance(rate, bool) or rate < 0:
+        raise ValueError(f"Invalid rate for {name}: {rate}")
+
+def _set_rates(rates: dict, changes: dict):
+    for name, rate in changes.items():
+        if rate is None:
+            rates.pop(name, None)
+        else:
+            rates[name] = rate
+
+def storage_pool(path: str):
+    """
+    The storage pool of an image under /mnt/{storageid}/, None for other paths.
+    """
+    if not path or not path.startswith("/mnt/"):
+        return None
+    return path.split("/")[2] or None
+
+# Bytes and requests per second
+throttle = Throttle(RATE, POOL_RATE, TRANSFER_RATE)
+iops_throttle = Throttle(IOPS, POOL_IOPS, TRANSFER_IOPS, follow=throttle)
+
+def limits() -> dict:
+    """
+    The bandwidth limits, with the request limits under "iops".
+    """
+    return dict(throttle.limits(), iops=iops_throttle.limits())
+
+def update_limits(limits: dict):
+    """
+    Change the limits given in the format of limits(). Nothing changes if
+    any of them is invalid.
+    """
+    iops = limits.get("iops", {})
+    if not isinstance(iops, dict):
+        raise ValueError(f"Invalid iops: {iops}")
+    throttle.check(limits)
+    try:
+        iops_throttle.check(iops)
+    except ValueError as e:
+        raise ValueError(f"iops: {e}") from None
+    throttle.update(limits)
+    iops_throttle.update(iops)
+
+async def consume(buckets: list, n: int):
+    """
+    Wait until n tokens may pass all buckets.
+    """
+    delay = max(bucket.reserve(n) for bucket in buckets)
+    if delay > 0:
+        observe("throttle_wait_seconds", delay)
+        await asyncio.sleep(delay)
+
+async def start_request(transfer_id: str = None, path: str = None):
+    """
+    Wait until one more request of the transfer of the image at path may start.
+    """
+    await consume(iops_throttle.buckets(transfer_id, path), 1)
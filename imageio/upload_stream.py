@@ -0,0 +1,335 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import stat
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import nbd
+from fastapi import Request
+
+from imageio.config import NBD
+from imageio.extents import zero_chunks
+from imageio.logging_imageio import logger
+from imageio.nbd_pool import MAX_WRITERS
+from imageio.nbd_stream import AioHandle
+from imageio.scheduler import stream_slots
+from imageio.throttle import throttle, consume, start_request
+
+# =============================
+# Config
+# =============================
+
+# Writes kept in flight per upload request, NBD commands for uploads over NBD
+WRITE_QUEUE_DEPTH = NBD.getint("write_queue_depth", fallback=8)
+
+# Threads doing the file writes and NBD zero and flush requests of the host
+WRITER_THREADS = NBD.getint("writer_threads", fallback=2 * MAX_WRITERS)
+
+# Uploads over NBD are checked for zeroes in blocks of this size, aligned to
+# the image offset; zero blocks are sent as NBD zero requests instead of data
+ZERO_DETECT_SIZE = NBD.getint("zero_detect_size", fallback=64 * 1024)
+ZERO_VIEW = memoryview(bytes(ZERO_DETECT_SIZE))
+
+# Largest range zeroed with one NBD zero request
+ZERO_REQUEST_MAX = 2 ** 30
+
+# fallocate(2) modes, not exposed by the os module
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+FALLOC_FL_ZERO_RANGE = 0x10
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+
+_write_executor = ThreadPoolExecutor(max_workers=WRITER_THREADS, thread_name_prefix="imageio-writer")
+
+# transfer id -> asyncio.Semaphore limiting the concurrent PUTs of a transfer,
+# dropped once no request of the transfer holds it
+upload_slots = weakref.WeakValueDictionary()
+
+# =============================
+# Helpers
+# =============================
+
+def content_range_start(request: Request) -> int:
+    """
+    Start offset of a PUT from its Content-Range header, e.g. "bytes 2097152-2162687/3758096384".
+    """
+    range_header = request.headers.get("content-range")
+    if not range_header:
+        return 0
+    _, range_part = range_header.split(" ")
+    start_s, _ = range_part.split("/")[0].split("-")
+    return int(start_s)
+
+def pwrite_all(fd: int, data, offset: int):
+    """
+    os.pwrite all of data at offset, continuing after short writes without copying.
+    """
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+
+def zero_blocks(data, offset: int, block_size: int = ZERO_DETECT_SIZE):
+    """
+    Split bytes or bytearray data written at offset into (start, end, zero)
+    runs of its blocks, positions relative to data. Blocks are aligned to the
+    image offset, so the first and last ones may be partial.
+    """
+    length = len(data)
+    head = min(-offset % block_size, length)
+    full = (length - head) // block_size
+
+    bounds = ([(0, head)] if head else []) + [(head + i * block_size, head + (i + 1) * block_size) for i in range(full)]
+    if head + full * block_size < length:
+        bounds.append((head + full * block_size, length))
+
+    runs = []
+    for start, end in bounds:
+        # A memcmp of the block in place, stopping at the first non zero byte;
+        # memoryview == would compare byte by byte
+        zero = data.startswith(ZERO_VIEW[:end - start], start, end)
+        if runs and runs[-1][2] == zero:
+            runs[-1] = (runs[-1][0], end, zero)
+        else:
+            runs.append((start, end, zero))
+    return runs
+
+def nbd_zero_range(h, offset: int, size: int):
+    """
+    Zero [offset, offset + size) over NBD. Fast zero is tried first, and when
+    the server cannot zero the range cheaply it is zeroed the normal way;
+    servers without zero support get zero buffers written.
+    """
+    if not h.can_zero():
+        for chunk in zero_chunks(size):
+            h.pwrite(chunk, offset)
+            offset += len(chunk)
+        return
+
+    fast = h.can_fast_zero()
+    end = offset + size
+    while offset < end:
+        n = min(end - offset, ZERO_REQUEST_MAX)
+        if fast:
+            try:
+                h.zero(n, offset, nbd.CMD_FLAG_FAST_ZERO)
+                offset += n
+                continue
+            except nbd.Error:
+                fast = False
+        h.zero(n, offset)
+        offset += n
+
+def fallocate(fd: int, mode: int, offset: int, size: int):
+    if _libc.fallocate(fd, mode, offset, size) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+def file_zero_range(fd: int, offset: int, size: int):
+    """
+    Zero [offset, offset + size) of a file without writing data: the range is
+    punched out, or zeroed in place by the file system when it cannot punch
+    holes. A range past the end of a regular file extends it. Zero buffers
+    are written only when the file system supports neither.
+    """
+    if size <= 0:
+        return
+    end = offset + size
+    st = os.fstat(fd)
+    if stat.S_ISREG(st.st_mode) and end > st.st_size:
+        # The new tail reads as zeroes already
+        os.ftruncate(fd, end)
+        end = max(offset, st.st_size)
+    if end <= offset:
+        return
+
+    for mode in (FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, FALLOC_FL_ZERO_RANGE | FALLOC_FL_KEEP_SIZE):
+        try:
+            fallocate(fd, mode, offset, end - offset)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS):
+                raise
+
+    for chunk in zero_chunks(end - offset):
+        pwrite_all(fd, chunk, offset)
+        offset += len(chunk)
+
+@asynccontextmanager
+async def upload_slot(transfer_id: str, path: str):
+    """
+    Wait until the request rates of the transfer and the storage pool of path
+    allow one more request, the transfer has less than max_writers PUTs in
+    progress, and the host has a free stream slot.
+    """
+    await start_request(transfer_id, path)
+    slots = upload_slots.get(transfer_id)
+    if slots is None:
+        slots = upload_slots[transfer_id] = asyncio.Semaphore(MAX_WRITERS)
+    async with slots, stream_slots.slot_async(transfer_id):
+        yield
+
+# =============================
+# Write pipeline
+# =============================
+
+async def write_stream(request: Request, offset: int, write, buckets: list = ()) -> tuple:
+    """
+    Write the request body from offset with write(data, offset) in the writer
+    threads. Body chunks are passed as they are, and up to WRITE_QUEUE_DEPTH
+    writes run while the next chunks are received, at the rate the throttle
+    buckets allow.
+    Returns the bytes received and the bytes write() reported as zeroed.
+    """
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    start = offset
+    zeroed = 0
+    try:
+        async for chunk in request.stream():
+            if not chunk:
+                continue
+            if buckets:
+                await consume(buckets, len(chunk))
+            pending.append(loop.run_in_executor(_write_executor, write, chunk, offset))
+            offset += len(chunk)
+            if len(pending) >= WRITE_QUEUE_DEPTH:
+                zeroed += await pending.popleft() or 0
+        while pending:
+            zeroed += await pending.popleft() or 0
+    finally:
+        if pending:
+            # The request failed, let the running writes end before the file or
+            # connection is closed under them
+            await asyncio.wait(pending)
+    return offset - start, zeroed
+
+async def _complete_first(aio: AioHandle, pending: deque) -> int:
+    # Wait for the oldest command, returning the bytes it zeroed
+    cookie, zeroed, _ = pending[0]
+    await aio.wait(cookie)
+    pending.popleft()
+    return zeroed
+
+async def nbd_write_stream(pool, h, request: Request, offset: int, buckets: list = ()) -> tuple:
+    """
+    Write the request body from offset with aio commands on a borrowed handle,
+    up to WRITE_QUEUE_DEPTH in flight while the next chunks are received, at
+    the rate the throttle buckets allow. Zero blocks are sent as zero requests
+    the server may turn into holes.
+    Returns the bytes received and the bytes sent as zero requests.
+    """
+    aio = AioHandle(h)
+    can_zero = h.can_zero()
+    # (cookie, bytes zeroed, data); body chunks are written as they are, see
+    # the libnbd buffer note in nbd_stream
+    pending = deque()
+    start = offset
+    zeroed = 0
+    try:
+        async for chunk in request.stream():
+            if not chunk:
+                continue
+            if buckets:
+                await consume(buckets, len(chunk))
+            view = memoryview(chunk)
+            runs = zero_blocks(chunk, offset) if can_zero else [(0, len(chunk), False)]
+            for run_start, run_end, zero in runs:
+                if zero:
+                    cookie = h.aio_zero(run_end - run_start, offset + run_start)
+                    pending.append((cookie, run_end - run_start, None))
+                else:
+                    data = view[run_start:run_end]
+                    pending.append((h.aio_pwrite(data, offset + run_start), 0, data))
+                if len(pending) >= WRITE_QUEUE_DEPTH:
+                    zeroed += await _complete_first(aio, pending)
+            aio.update_interest()
+            offset += len(chunk)
+        while pending:
+            zeroed += await _complete_first(aio, pending)
+    finally:
+        aio.close()
+        if pending:
+            # The connection still has writes in flight, do not reuse it
+            logger.debug(f"Dropping NBD connection with {len(pending)} writes in flight")
+            pool.discard_on_release(h)
+    return offset - start, zeroed
+
+async def upload_to_file(path: str, request: Request, transfer_id: str):
+    """
+    Write a PUT to a file with os.pwrite, off the event loop.
+    """
+    start = content_range_start(request)
+    async with upload_slot(transfer_id, path):
+        fd = await asyncio.to_thread(os.open, path, os.O_WRONLY)
+        try:
+            written, _ = await write_stream(request, start, lambda data, offset: pwrite_all(fd, data, offset),
+                    throttle.buckets(transfer_id, path))
+        finally:
+            os.close(fd)
+    logger.debug(f"Wrote {written} bytes to {path} starting at offset {start}")
+
+async def upload_to_nbd(pool, request: Request, transfer_id: str):
+    """
+    Write a PUT with aio commands on a pooled NBD connection and flush it.
+    """
+    start = content_range_start(request)
+    async with upload_slot(transfer_id, pool.image):
+        async with pool.aconnection() as h:
+            written, zeroed = await nbd_write_stream(pool, h, request, start,
+                    throttle.buckets(transfer_id, pool.image))
+            await run_writer(h.flush)
+    logger.debug(f"Wrote {written} bytes to {pool.image} via NBD starting at offset {start}, {zeroed} of them as zero requests")
+
+# =============================
+# PATCH operations
+# =============================
+
+async def run_writer(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_write_executor, func, *args)
+
+async def zero_file(path: str, transfer_id: str, offset: int, size: int, flush: bool = False):
+    """
+    Zero a range of a file, punching a hole where the file system can.
+    """
+    async with upload_slot(transfer_id, path):
+        fd = await asyncio.to_thread(os.open, path, os.O_WRONLY)
+        try:
+            await run_writer(file_zero_range, fd, offset, size)
+            if flush:
+                await run_writer(os.fsync, fd)
+        finally:
+            os.close(fd)
+    logger.debug(f"Zeroed {size} bytes of {path} at offset {offset}")
+
+async def flush_file(path: str, transfer_id: str):
+    await start_request(transfer_id, path)
+    fd = await asyncio.to_thread(os.open, path, os.O_WRONLY)
+    try:
+        await run_writer(os.fsync, fd)
+    finally:
+        os.close(fd)
+
+async def zero_nbd(pool, transfer_id: str, offset: int, size: int, flush: bool = False):
+    """
+    Zero a range over a pooled NBD connection.
+    """
+    async with upload_slot(transfer_id, pool.image):
+        async with pool.aconnection() as h:
+            await run_writer(nbd_zero_range, h, offset, size)
+            if flush:
+                await run_writer(h.flush)
+    logger.debug(f"Zeroed {size} bytes of {pool.image} via NBD at offset {offset}")
+
+async def flush_nbd(pool, transfer_id: str):
+    await start_request(transfer_id, pool.image)
+    async with pool.aconnection() as h:
+        await run_writer(h.flush)
@@ -1,4 +1,6 @@
-from fastapi import Request
+import zlib
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
 
 # =========================
 # Internal Authentication
@@ -18,3 +20,79 @@ def check_internal_auth(request: Request, INTERNAL_TOKEN: str) -> bool:
 
     # Check if the header matches the internal token
     return auth_header.strip() == INTERNAL_TOKEN
+
+# =========================
+# Response compression
+# =========================
+
+def accepts_gzip(request: Request) -> bool:
+    """
+    Check if the client accepts gzip encoded responses
+    """
+    for coding in request.headers.get("Accept-Encoding", "").split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() == "gzip":
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+def gzip_stream(chunks):
+    """
+    Gzip compress a stream of byte chunks on the fly
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+# =========================
+# Range downloads
+# =========================
+
+def range_response(request: Request, size: int, reader) -> StreamingResponse:
+    """
+    Stream the Range of the request, or everything, with reader(start, length)
+    """
+    range_header = request.headers.get("range")
+
+    if not range_header:
+        # No range requested, return full file
+        return StreamingResponse(
+            reader(0, size),
+            headers={"Content-Length": str(size)},
+            media_type="application/octet-stream"
+        )
+
+    # Parse range header (format: "bytes=start-end")
+    try:
+        range_type, range_spec = range_header.split("=")
+        if range_type.strip().lower() != "bytes":
+            raise HTTPException(status_code=400, detail="Invalid range type")
+
+        start_str, end_str = range_spec.split("-")
+        start = int(start_str)
+        end = int(end_str) if end_str else size - 1
+
+        # Handle negative values and bounds checking
+        if start < 0 or start >= size:
+            raise HTTPException(status_code=416, detail="Range Not Satisfiable")
+        end = min(end, size - 1)
+
+        length = end - start + 1
+
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid range format")
+
+    headers = {
+        "Content-Range": f"bytes {start}-{start+length-1}/{size}/*",
+        "Content-Length": str(length),
+        "Accept-Ranges": "bytes"
+    }
+
+    return StreamingResponse(
+        reader(start, length),
+        media_type="application/octet-stream",
+        headers=headers,
+        status_code=206
+    )